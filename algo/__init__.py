@@ -15,4 +15,7 @@
 """
 
 from .create_clustering import *
-from .compute_confidence import *
\ No newline at end of file
+from .compute_confidence import *
+from .circular_statistics import *
+from .incremental_clustering import *
+from .forecast import *
\ No newline at end of file
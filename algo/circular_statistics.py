@@ -0,0 +1,61 @@
+import numpy as np
+from .create_clustering import SECONDS_PER_DAY
+
+class CircularHistogram:
+    """Counts of events per second of the day.
+
+    Only occupied seconds are kept, as a sorted array of seconds and one of their
+    counts, so the memory grows with the distinct seconds of the history instead of
+    the seconds of the day. The spread of the events within an arc of the day is read
+    from the bins of that arc alone.
+    """
+
+    def __init__(self):
+        self.seconds = np.empty(0, dtype=np.int32)
+        self.counts = np.empty(0, dtype=np.int32)
+
+    def add(self, day_seconds):
+        self.__update(day_seconds, 1)
+
+    def remove(self, day_seconds):
+        self.__update(day_seconds, -1)
+
+    def __update(self, day_seconds, sign):
+        values, counts = np.unique(np.asarray(day_seconds, dtype=np.int32), return_counts=True)
+        if len(values) == 0:
+            return
+        positions = np.searchsorted(self.seconds, values)
+        present = positions < len(self.seconds)
+        present[present] = self.seconds[positions[present]] == values[present]
+        self.counts[positions[present]] += sign*counts[present].astype(np.int32)
+        if not present.all():
+            self.seconds = np.insert(self.seconds, positions[~present], values[~present])
+            self.counts = np.insert(self.counts, positions[~present], sign*counts[~present])
+        if sign < 0:
+            emptied = self.counts == 0
+            if emptied.any():
+                self.seconds = self.seconds[~emptied]
+                self.counts = self.counts[~emptied]
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+    def spread(self, first: int, last: int):
+        # Root mean squared distance in seconds of the events within the arc first..last (first > last wraps
+        # around midnight) from their mean, like compute_second_momentum computes it from the timestamps.
+        start = np.searchsorted(self.seconds, first)
+        end = np.searchsorted(self.seconds, last, side="right")
+        if first <= last:
+            seconds = self.seconds[start:end].astype(np.int64)
+            counts = self.counts[start:end].astype(np.float64)
+        else:
+            # Seconds after midnight continue the arc beyond SECONDS_PER_DAY.
+            seconds = np.concatenate((self.seconds[start:].astype(np.int64), self.seconds[:end].astype(np.int64) + SECONDS_PER_DAY))
+            counts = np.concatenate((self.counts[start:], self.counts[:end])).astype(np.float64)
+        n = counts.sum()
+        if n == 0:
+            return 0.0
+        mean = np.dot(counts, seconds)/n
+        distances = np.abs(seconds - mean)
+        distances = np.minimum(distances, SECONDS_PER_DAY - distances)
+        return float(np.sqrt(np.dot(counts, distances**2)/n))
@@ -1,18 +1,39 @@
-import pandas as pd
 import numpy as np
-from .create_clustering import compute_frac_of_day
+import datetime
+from .create_clustering import compute_frac_of_day, compute_frac_of_day_array, to_epoch_nanoseconds, NS_PER_SECOND, SECONDS_PER_DAY
 
-def compute_second_momentum(list_of_ts:list):
-    list_of_frac = list(map(compute_frac_of_day, list_of_ts))
+NS_PER_DAY = SECONDS_PER_DAY*NS_PER_SECOND
+
+def compute_second_momentum(list_of_ts):
+    list_of_frac = compute_frac_of_day_array(list_of_ts)
+    # Averaging needs the fractions on the day centered at their circular mean, otherwise a cluster
+    # around midnight averages to noon. Fractions already on that day are left as they are, that is
+    # all of them if they lie within half a day.
+    if np.ptp(list_of_frac) >= 0.5:
+        lower_end = compute_circular_mean_of_fracs(list_of_frac) - 0.5
+        list_of_frac = np.where(list_of_frac < lower_end, list_of_frac + 1, np.where(list_of_frac >= lower_end + 1, list_of_frac - 1, list_of_frac))
     mean = np.mean(list_of_frac)
-    non_avg_momentum = 0
-    for frac in list_of_frac:
-        non_avg_momentum = non_avg_momentum + (min(max(frac, mean)-min(frac, mean), 1+min(frac, mean)-max(frac, mean)))**2
+    lower = np.minimum(list_of_frac, mean)
+    upper = np.maximum(list_of_frac, mean)
+    # Distance on the circle of fractions. cumsum adds the squares up one by one, in the same order
+    # as the former loop did, instead of np.sum's pairwise summation.
+    squared_distances = np.minimum(upper-lower, 1+lower-upper)**2
+    non_avg_momentum = np.cumsum(squared_distances)[-1]
     momentum = np.sqrt(non_avg_momentum/len(list_of_frac))
     return momentum*24*3600
 
-def compute_confidence_from_spreading(ts_in_cluster:list, high_confidence_boundary: float, low_confidence_boundary: float):
+def compute_circular_mean_of_fracs(list_of_frac):
+    angles = 2*np.pi*np.asarray(list_of_frac)
+    sin_sum, cos_sum = np.sin(angles).sum(), np.cos(angles).sum()
+    if abs(sin_sum) < 1e-9 and abs(cos_sum) < 1e-9:
+        return 0.5  # no mean direction, keep the fractions on [0, 1)
+    return np.arctan2(sin_sum, cos_sum) % (2*np.pi)/(2*np.pi)
+
+def compute_confidence_from_spreading(ts_in_cluster, high_confidence_boundary: float, low_confidence_boundary: float):
     second_momentum = compute_second_momentum(ts_in_cluster)
+    return compute_confidence_from_second_momentum(second_momentum, high_confidence_boundary, low_confidence_boundary)
+
+def compute_confidence_from_second_momentum(second_momentum: float, high_confidence_boundary: float, low_confidence_boundary: float):
     confidence = -1/(low_confidence_boundary - high_confidence_boundary)*second_momentum + 1+(high_confidence_boundary)/(low_confidence_boundary-high_confidence_boundary)
     if confidence >= 1:
         confidence = 1
@@ -21,35 +42,45 @@ def compute_confidence_from_spreading(ts_in_cluster:list, high_confidence_bounda
     return confidence
 
 
-def check_for_times_during_last_x_days(current_timestamp, considered_timestamps: list, pair_of_boundaries: tuple, confidence_days=7):
-    current_day = current_timestamp.floor("d")
-    # Convert time object corresponding to left boundary into timedelta
-    delta_min_boundary = pd.Timestamp.combine(pd.Timestamp("2000-01-01"), pair_of_boundaries[0]) - pd.Timestamp("2000-01-01")
-
-    # Convert time object corresponding to left boundary into timedelta
-    delta_max_boundary = pd.Timestamp.combine(pd.Timestamp("2000-01-01"), pair_of_boundaries[1]) - pd.Timestamp("2000-01-01")
-    
-    nr_days_in_cluster = 0
-    already_considered_days = 0
-    
-    for i in range(50):
-        if check_if_weekend(current_timestamp) == check_if_weekend(current_timestamp - (i+1)*pd.Timedelta(1, "d")):
-            for window_opening_time in considered_timestamps:
-                if (current_day - (i+1)*pd.Timedelta(1, "d") + delta_min_boundary <= window_opening_time and 
-                    window_opening_time <= current_day - (i+1)*pd.Timedelta(1, "d") + delta_max_boundary):
-                    nr_days_in_cluster += 1
-                    break
-            already_considered_days += 1
-            if already_considered_days == confidence_days:
-                break
-
-    return nr_days_in_cluster
-
-def compute_confidence_by_daily_apperance(current_timestamp, considered_timestamps: list, pair_of_boundaries: tuple, confidence_days=7):
-    nr_days_in_cluster = check_for_times_during_last_x_days(current_timestamp, considered_timestamps, pair_of_boundaries, confidence_days=7)
+def check_for_times_during_last_x_days(current_timestamp, considered_timestamps, pair_of_boundaries: tuple, confidence_days=7):
+    return int(check_for_times_during_last_x_days_batch(current_timestamp, considered_timestamps, [pair_of_boundaries], confidence_days=confidence_days)[0])
+
+def check_for_times_during_last_x_days_batch(current_timestamp, considered_timestamps, list_of_boundaries: list, confidence_days=7):
+    # For every pair of boundaries: On how many of the last confidence_days days of the same type
+    # (weekday/weekend, looking back at most 50 days) was there an opening between the boundaries?
+    opening_times = to_epoch_nanoseconds(considered_timestamps)
+    if np.any(opening_times[1:] < opening_times[:-1]):
+        opening_times = np.sort(opening_times)
+
+    current_day = to_epoch_nanoseconds([current_timestamp])[0] // NS_PER_DAY
+    past_days = current_day - np.arange(1, 51)
+    past_days = past_days[is_weekend_day(past_days) == is_weekend_day(current_day)][:confidence_days]
+
+    min_boundaries = np.array([time_to_nanoseconds(pair[0]) for pair in list_of_boundaries], dtype=np.int64)
+    max_boundaries = np.array([time_to_nanoseconds(pair[1]) for pair in list_of_boundaries], dtype=np.int64)
+    # Boundaries wrapping around midnight: The evening of a day and the morning of the next one, the day the arc starts on counts.
+    max_boundaries = np.where(max_boundaries < min_boundaries, max_boundaries + NS_PER_DAY, max_boundaries)
+    day_starts = past_days[:, np.newaxis]*NS_PER_DAY
+    first_inside = np.searchsorted(opening_times, day_starts + min_boundaries, side="left")
+    first_after = np.searchsorted(opening_times, day_starts + max_boundaries, side="right")
+    return np.count_nonzero(first_after > first_inside, axis=0)
+
+def compute_confidence_by_daily_apperance(current_timestamp, considered_timestamps, pair_of_boundaries: tuple, confidence_days=7):
+    nr_days_in_cluster = check_for_times_during_last_x_days(current_timestamp, considered_timestamps, pair_of_boundaries, confidence_days=confidence_days)
     return nr_days_in_cluster/confidence_days
 
-def check_if_weekend(current_timestamp: pd.Timestamp):
+def compute_confidence_by_daily_apperance_batch(current_timestamp, considered_timestamps, list_of_boundaries: list, confidence_days=7):
+    nr_days_in_clusters = check_for_times_during_last_x_days_batch(current_timestamp, considered_timestamps, list_of_boundaries, confidence_days=confidence_days)
+    return nr_days_in_clusters/confidence_days
+
+def time_to_nanoseconds(time: datetime.time):
+    return ((time.hour*3600 + time.minute*60 + time.second)*10**6 + time.microsecond)*1000
+
+def is_weekend_day(days_since_epoch):
+    # 1970-01-01 was a thursday
+    return (days_since_epoch + 3) % 7 >= 5
+
+def check_if_weekend(current_timestamp: "pd.Timestamp"):
         if current_timestamp.weekday() <= 4: # Mo, Tu, Wd, Th, Fr
             return False
         else:
@@ -1,11 +1,14 @@
-import pandas as pd
 import math
+import datetime
 import numpy as np
-from sklearn.cluster import DBSCAN
+# pandas and scikit-learn are imported where they are needed, so importing algo stays cheap.
 
 EPSILON = .06
 
-def convert_to_day_seconds(ts: pd.Timestamp):
+NS_PER_SECOND = 10**9
+SECONDS_PER_DAY = 24*3600
+
+def convert_to_day_seconds(ts: "pd.Timestamp"):
     ts = ts.round("1s")
     ts_hour = ts.hour
     ts_minute = ts.minute
@@ -13,36 +16,94 @@ def convert_to_day_seconds(ts: pd.Timestamp):
     day_seconds = ts_hour*3600 + ts_minute*60 + ts_second
     return day_seconds
 
-def compute_frac_of_day(ts:pd.Timestamp):
+def compute_frac_of_day(ts:"pd.Timestamp"):
     total_seconds_day = 24*3600
     return convert_to_day_seconds(ts)/total_seconds_day
 
-def project_to_unit_circle(ts:pd.Timestamp):
+def project_to_unit_circle(ts:"pd.Timestamp"):
     frac_of_day = compute_frac_of_day(ts)
     proj_unit_circle = (math.cos(2*math.pi*frac_of_day), math.sin(2*math.pi*frac_of_day))
     return proj_unit_circle
 
-def compute_clustering(window_opening_times: list):
-    # Compute the projection onto the unit circle for all window opening times
-    projections_onto_circle = list(map(lambda x: project_to_unit_circle(x), window_opening_times))
-    projections_onto_circle = np.array(projections_onto_circle)
+def to_epoch_nanoseconds(timestamps) -> np.ndarray:
+    # Accepts lists of timestamps, datetime64 arrays and int64 arrays of epoch seconds (as kept by the event store).
+    if len(timestamps) == 0:
+        return np.empty(0, dtype=np.int64)
+    array = np.asarray(timestamps)
+    if np.issubdtype(array.dtype, np.datetime64):
+        return array.astype("datetime64[ns]").view(np.int64)
+    if np.issubdtype(array.dtype, np.integer):
+        return array.astype(np.int64) * NS_PER_SECOND
+    import pandas as pd
+    return pd.DatetimeIndex(timestamps).asi8
+
+def convert_to_day_seconds_array(timestamps) -> np.ndarray:
+    ns = to_epoch_nanoseconds(timestamps)
+    # Same rounding as pd.Timestamp.round("1s"): to the nearest second, ties to even.
+    seconds, remainder = np.divmod(ns, NS_PER_SECOND)
+    half = NS_PER_SECOND // 2
+    seconds = seconds + ((remainder > half) | ((remainder == half) & (seconds % 2 == 1)))
+    return seconds % SECONDS_PER_DAY
+
+def compute_frac_of_day_array(timestamps) -> np.ndarray:
+    return convert_to_day_seconds_array(timestamps)/SECONDS_PER_DAY
 
-    clustering = DBSCAN(eps=EPSILON, min_samples=2).fit(projections_onto_circle)
+def project_to_unit_circle_array(timestamps) -> np.ndarray:
+    frac_of_day = compute_frac_of_day_array(timestamps)
+    return np.column_stack((np.cos(2*math.pi*frac_of_day), np.sin(2*math.pi*frac_of_day)))
+
+def compute_clustering(window_opening_times, clustering=None):
+    day_seconds = convert_to_day_seconds_array(window_opening_times)
+    if clustering is None:
+        # Same clusters as compute_dbscan_labels, without the need for scikit-learn
+        from .incremental_clustering import IncrementalClustering
+        clustering = IncrementalClustering.fit(day_seconds)
+    # Otherwise an IncrementalClustering that is kept up to date with window_opening_times
+    labels = clustering.labels(day_seconds)
     clusters = {}
     indices = {}
-    for c in np.unique(clustering.labels_):
-        ix = np.where(clustering.labels_ == c)
+    for c in np.unique(labels):
+        ix = np.where(labels == c)
         indices[c] = ix[0]
-        clusters[c] = [window_opening_times[i] for i in ix[0]]
+        if isinstance(window_opening_times, np.ndarray):
+            clusters[c] = window_opening_times[ix[0]]
+        else:
+            clusters[c] = [window_opening_times[i] for i in ix[0]]
     return clusters, indices
 
-def compute_clusters_boundaries(window_opening_times: list):
-    clusters, indices = compute_clustering(window_opening_times)
+def compute_dbscan_labels(window_opening_times):
+    # Reference implementation, needs scikit-learn.
+    from sklearn.cluster import DBSCAN
+    # Compute the projection onto the unit circle for all window opening times
+    projections_onto_circle = project_to_unit_circle_array(window_opening_times)
+    return DBSCAN(eps=EPSILON, min_samples=2).fit(projections_onto_circle).labels_
+
+def compute_clusters_boundaries(window_opening_times, clustering=None):
+    # (first, last) time of day of every cluster. A cluster's arc may wrap around midnight, then first > last.
+    day_seconds = convert_to_day_seconds_array(window_opening_times)
+    if clustering is None:
+        from .incremental_clustering import IncrementalClustering
+        clustering = IncrementalClustering.fit(day_seconds)
+    clusters, indices = compute_clustering(window_opening_times, clustering=clustering)
+    # Time of day in microseconds, like pd.Timestamp.time() does
+    time_of_day = to_epoch_nanoseconds(window_opening_times) % (SECONDS_PER_DAY*NS_PER_SECOND) // 1000
+    # The arc of every cluster, from its first point. Noise is no arc.
+    arcs = {c: clustering.segments()[segment] for c, segment in zip(indices, clustering.segment_indices([day_seconds[indices[c][0]] for c in indices])) if c != -1}
     clusters_boundaries = {}
     for c in clusters.keys():
-        cluster_minimum = min(map(lambda x: x.time(), clusters[c]))
-        cluster_maximum = max(map(lambda x: x.time(), clusters[c]))
-        clusters_boundaries[c] = (cluster_minimum, cluster_maximum)
+        cluster_time_of_day = time_of_day[indices[c]]
+        if c == -1:
+            clusters_boundaries[c] = (microseconds_to_time(cluster_time_of_day.min()), microseconds_to_time(cluster_time_of_day.max()))
+            continue
+        # Unrolled from the start of the arc, half a second before its first second as openings are rounded to seconds
+        arc_start = arcs[c][0]*10**6 - 10**6 // 2
+        since_arc_start = (cluster_time_of_day - arc_start) % (SECONDS_PER_DAY*10**6)
+        cluster_first = microseconds_to_time((arc_start + since_arc_start.min()) % (SECONDS_PER_DAY*10**6))
+        cluster_last = microseconds_to_time((arc_start + since_arc_start.max()) % (SECONDS_PER_DAY*10**6))
+        clusters_boundaries[c] = (cluster_first, cluster_last)
 
     return clusters_boundaries, indices
 
+def microseconds_to_time(microseconds: int):
+    seconds, microseconds = divmod(int(microseconds), 10**6)
+    return datetime.time(seconds // 3600, seconds % 3600 // 60, seconds % 60, microseconds)
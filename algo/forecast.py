@@ -0,0 +1,36 @@
+import contextlib
+
+import numpy as np
+from .create_clustering import compute_clusters_boundaries
+from .create_clustering import to_epoch_nanoseconds, NS_PER_SECOND, SECONDS_PER_DAY
+from .incremental_clustering import IncrementalClustering
+from .compute_confidence import compute_confidence_from_spreading, compute_confidence_from_second_momentum, compute_confidence_by_daily_apperance_batch
+
+def compute_day_forecast(current_timestamp, considered_timestamps, high_confidence_boundary: float, low_confidence_boundary: float, confidence_days=7, clustering=None, timer=None):
+    # One entry (pair_of_boundaries, confidence_by_spreading, confidence_by_daily_appearance, overall_confidence) per cluster.
+    # timer(stage) may return a context manager timing the "clustering" and "confidence" stages.
+    if timer is None:
+        timer = lambda stage: contextlib.nullcontext()
+    if not isinstance(considered_timestamps, np.ndarray):
+        considered_timestamps = np.asarray(considered_timestamps, dtype=object)
+    with timer("clustering"):
+        clusters_boundaries, indices = compute_clusters_boundaries(considered_timestamps, clustering=clustering)
+    with timer("confidence"):
+        confidences_by_daily_appearance = compute_confidence_by_daily_apperance_batch(current_timestamp, considered_timestamps, list(clusters_boundaries.values()), confidence_days=confidence_days)
+        forecast = []
+        for c, confidence_by_daily_appearance in zip(clusters_boundaries.keys(), confidences_by_daily_appearance):
+            if clustering is not None and c != -1:
+                # The spread is read from the clustering's histogram instead of the cluster's timestamps, noise is no arc.
+                day_second = to_epoch_nanoseconds(considered_timestamps[indices[c][:1]])[0] // NS_PER_SECOND % SECONDS_PER_DAY
+                confidence_by_spreading = compute_confidence_from_second_momentum(clustering.spread(day_second), high_confidence_boundary, low_confidence_boundary)
+            else:
+                ts_in_cluster = considered_timestamps[indices[c]]
+                confidence_by_spreading = compute_confidence_from_spreading(ts_in_cluster, high_confidence_boundary, low_confidence_boundary)
+            overall_confidence = confidence_by_spreading * confidence_by_daily_appearance
+            forecast.append((clusters_boundaries[c], confidence_by_spreading, confidence_by_daily_appearance, overall_confidence))
+    return forecast
+
+def compute_day_forecast_from_seconds(current_timestamp, considered_seconds, high_confidence_boundary: float, low_confidence_boundary: float, confidence_days=7):
+    # For worker processes: Fitting the clustering is cheaper than receiving its counters.
+    clustering = IncrementalClustering.fit(considered_seconds % SECONDS_PER_DAY)
+    return compute_day_forecast(current_timestamp, considered_seconds, high_confidence_boundary, low_confidence_boundary, confidence_days=confidence_days, clustering=clustering)
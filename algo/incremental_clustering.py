@@ -0,0 +1,103 @@
+import math
+import numpy as np
+from .create_clustering import EPSILON, SECONDS_PER_DAY
+from .circular_statistics import CircularHistogram
+
+# Two points on the unit circle are closer than EPSILON iff their day times are at most this many seconds apart.
+NEIGHBOUR_SECONDS = math.floor(math.asin(EPSILON/2)/math.pi*SECONDS_PER_DAY)
+
+class IncrementalClustering:
+    """Clustering of day seconds that can be updated point by point.
+
+    On the circle, DBSCAN(eps=EPSILON, min_samples=2) reduces to cutting the ring of
+    sorted day seconds at every gap larger than NEIGHBOUR_SECONDS; runs holding a
+    single point are noise. The ring is kept as the occupied seconds of the day with
+    their counts, so the cut is one pass over the ring. These are the bins of a
+    CircularHistogram, which gives the spread of a cluster. The clustering is not
+    stored, fitting it on the history when a device is loaded is one pass as well.
+    """
+
+    def __init__(self):
+        self.histogram = CircularHistogram()
+        self.__segments = None
+        self.__lookup = None
+
+    @classmethod
+    def fit(cls, day_seconds):
+        clustering = cls()
+        clustering.add(day_seconds)
+        return clustering
+
+    def add(self, day_seconds):
+        self.histogram.add(day_seconds)
+        self.__segments = None
+        self.__lookup = None
+
+    def remove(self, day_seconds):
+        self.histogram.remove(day_seconds)
+        self.__segments = None
+        self.__lookup = None
+
+    def __len__(self):
+        return len(self.histogram)
+
+    def segments(self):
+        # Clusters as arcs (first second, last second). An arc wrapping around midnight has first > last.
+        if self.__segments is None:
+            self.__segments = self.__compute_segments()
+        return self.__segments
+
+    def __compute_segments(self):
+        occupied = self.histogram.seconds
+        if len(occupied) == 0:
+            return []
+        cuts = np.flatnonzero(np.diff(occupied) > NEIGHBOUR_SECONDS)
+        starts = np.concatenate(([0], cuts + 1))
+        ends = np.concatenate((cuts, [len(occupied) - 1]))
+        arcs = [[occupied[start], occupied[end]] for start, end in zip(starts, ends)]
+        cumulative_counts = np.concatenate(([0], np.cumsum(self.histogram.counts)))
+        point_counts = list(cumulative_counts[ends + 1] - cumulative_counts[starts])
+        if len(arcs) > 1 and occupied[0] + SECONDS_PER_DAY - occupied[-1] <= NEIGHBOUR_SECONDS:
+            arcs[0][0] = arcs[-1][0]
+            point_counts[0] += point_counts[-1]
+            arcs.pop()
+            point_counts.pop()
+        return [(int(first), int(last)) for (first, last), n in zip(arcs, point_counts) if n >= 2]
+
+    def segment_of(self, day_second: int):
+        # The arc holding day_second, None for noise
+        segment = self.segment_indices([day_second])[0]
+        return self.segments()[segment] if segment >= 0 else None
+
+    def spread(self, day_second: int):
+        # Root mean squared distance in seconds from the mean of the cluster holding day_second
+        return self.histogram.spread(*self.segment_of(day_second))
+
+    def labels(self, day_seconds):
+        # Labels like DBSCAN assigns them: clusters are numbered in order of their first point, noise is -1.
+        segment_labels = self.segment_indices(day_seconds)
+        in_cluster = segment_labels >= 0
+        segments_in_order = segment_labels[in_cluster][np.sort(np.unique(segment_labels[in_cluster], return_index=True)[1])]
+        # The extra last entry maps the noise label -1 to itself.
+        renumbering = np.full(len(self.segments()) + 1, -1, dtype=np.int64)
+        renumbering[segments_in_order] = np.arange(len(segments_in_order))
+        return renumbering[segment_labels]
+
+    def segment_indices(self, day_seconds):
+        # Index into segments() of the arc holding each day second, -1 for noise
+        if self.__lookup is None:
+            # Arcs as sorted, non-overlapping pieces (first, last, index), an arc around midnight is split in two.
+            pieces = []
+            for i, (first, last) in enumerate(self.segments()):
+                if first <= last:
+                    pieces.append((first, last, i))
+                else:
+                    pieces += [(first, SECONDS_PER_DAY - 1, i), (0, last, i)]
+            self.__lookup = np.array(sorted(pieces), dtype=np.int64).reshape(-1, 3)
+        day_seconds = np.asarray(day_seconds, dtype=np.int64)
+        if len(self.__lookup) == 0:
+            return np.full(len(day_seconds), -1, dtype=np.int64)
+        firsts, lasts, indices = self.__lookup.T
+        piece = np.searchsorted(firsts, day_seconds, side="right") - 1
+        inside = (piece >= 0) & (day_seconds <= lasts[np.maximum(piece, 0)])
+        return np.where(inside, indices[np.maximum(piece, 0)], -1)
@@ -17,23 +17,42 @@
 __all__ = ("Operator", )
 
 import typing
+import logging
 
 import dotenv
 dotenv.load_dotenv()
 
 from operator_lib.util import OperatorBase, logger, InitPhase
-from operator_lib.util.persistence import save, load
+from operator_lib.util.persistence import load
 import os
 import datetime
+import threading
+import heapq
 import pandas as pd
-from algo import compute_clusters_boundaries, compute_confidence_from_spreading, compute_confidence_by_daily_apperance
-from collections import defaultdict
+import numpy as np
+from algo import compute_day_forecast, compute_day_forecast_from_seconds, is_weekend_day, IncrementalClustering, SECONDS_PER_DAY
+from storage import EventStore, DeviceRegistry, ForecastCache, WriteAheadLog, Checkpointer, write_columnar, read_columnar
+from runtime import to_utc_nanoseconds, utc_to_local, utc_to_local_array, local_to_utc, format_utc, Metrics, MetricsExporter, ForecastScheduler
+import time
 
 
 
 FIRST_DATA_FILENAME = "first_data_time.pickle"
 LAST_TIMESTAMP_FILE = "last_timestamp.pickle"
 WINDOW_OPENING_TIMES_FILE = "window_opening_times.pickle"
+WINDOW_OPENING_TIMES_DIR = "window_opening_times"
+BUCKETS = ("weekday", "weekend")
+# Durations of the episodes started at the entries of the same position in the bucket, in seconds
+DURATION_BUCKETS = {bucket: f"{bucket}_duration" for bucket in BUCKETS}
+# all: every message with an open window is a window opening, transitions: only closed->open transitions are,
+# episodes: like transitions, additionally the duration of each opening is stored.
+OPENING_EVENT_MODES = ("all", "transitions", "episodes")
+DEVICES_DIR = "devices"
+FORECAST_CACHE_FILE = "forecast_cache.json"
+# State of messages without a device id, as single-device deployments send them
+DEFAULT_DEVICE_ID = "default"
+# State of operator versions that served a single device from the root of data_path.
+LEGACY_STATE = (FIRST_DATA_FILENAME, LAST_TIMESTAMP_FILE, WINDOW_OPENING_TIMES_FILE, WINDOW_OPENING_TIMES_DIR)
 
 
 from operator_lib.util import Config
@@ -49,8 +68,36 @@ class CustomConfig(Config):
 
     confidence_days: int = 7 # in days
 
+    retention_days: float = 60 # in days, window openings older than this are forgotten
+
     contact_sensor: bool = True
 
+    max_loaded_devices: int = 1000 # number of devices whose state is held in memory
+
+    forecast_cache_size: int = 4096 # number of daily forecasts kept for replayed day boundaries
+
+    metrics_file: str = "" # write metrics in the prometheus text format to this file, disabled if empty
+    metrics_port: int = 0 # serve metrics at http://<host>:<port>/metrics, disabled if 0
+    metrics_interval: float = 15 # in seconds, how often metrics_file is written
+
+    checkpoint_interval: float = 30 # in seconds, how often changed state is written to disk
+    checkpoint_messages: int = 10000 # number of messages after which changed state is written to disk at the latest
+
+    opening_event_mode: str = "all" # one of all, transitions, episodes
+
+    forecast_workers: int = 0 # number of processes computing the daily forecasts, 0 computes them while consuming
+    max_pending_forecasts: int = 1000 # consuming waits while this many forecasts are computing
+
+    batch_messages: int = 0 # number of consecutive messages applied to the state together, 0 applies every message on its own
+    batch_interval: float = 1 # in seconds, how long a message waits for the rest of its batch at most
+
+    reorder_window: float = 0 # in seconds, messages are held back this long to be applied in time order, 0 applies them on arrival
+    reorder_messages: int = 1000 # number of messages held back per device at most
+
+    horizon_days: int = 0 # stopping times of this many days ahead are produced for every device each horizon_interval, disabled if 0
+    horizon_interval: float = 3600 # in seconds
+
+
     def __init__(self, d, **kwargs):
         super().__init__(d, **kwargs)
 
@@ -62,11 +109,210 @@ class CustomConfig(Config):
         if self.init_phase_level == '':
             self.init_phase_level = 'd'
 
+        if self.opening_event_mode == '':
+            self.opening_event_mode = 'all'
+
+class DeviceState:
+    def __init__(self, device_id, data_path, init_phase_duration, produce, opening_event_mode="all"):
+        self.device_id = device_id
+        self.data_path = data_path
+        self.init_phase_duration = init_phase_duration
+        self.produce = produce
+        self.opening_event_mode = opening_event_mode
+
+        self.window_opening_times = EventStore(os.path.join(self.data_path, WINDOW_OPENING_TIMES_DIR), buckets=BUCKETS + tuple(DURATION_BUCKETS.values()))
+        if not self.window_opening_times.exists():
+            self.migrate_window_opening_times()
+
+        # Committed together with the history. Pickles are only left by earlier versions.
+        metadata = self.window_opening_times.metadata
+        if "seq" not in metadata:
+            metadata = {
+                "first_data_time": from_timestamp(load(self.data_path, FIRST_DATA_FILENAME)),
+                "last_timestamp": from_timestamp(load(self.data_path, LAST_TIMESTAMP_FILE))
+            }
+        self.apply_metadata(metadata)
+        self.clusterings = {bucket: self.fit_clustering(bucket) for bucket in BUCKETS}
+        # Since loaded, to see how much recording only transitions saves
+        self.open_samples = 0
+        self.recorded_openings = 0
+
+    def metadata(self):
+        return {
+            # Sequence number of the last write-ahead log record applied to this device
+            "seq": self.seq,
+            "first_data_time": from_timestamp(self.first_data_time),
+            "last_timestamp": from_timestamp(self.last_timestamp),
+            # Window state of the last message and [bucket, seconds] of the start of the current opening episode
+            "window_open": self.window_open,
+            "episode_start": self.episode_start,
+            # Day boundary of the latest forecast, late window openings before it change the forecast
+            "forecast_timestamp": from_timestamp(self.forecast_timestamp),
+            # [utc_ns, seq, window_open] of the messages held back, see reorder
+            "reorder_buffer": self.reorder_buffer,
+            "latest_message": self.latest_message,
+            # Number of late window openings inserted per bucket, part of the history's fingerprint
+            "late_insertions": self.late_insertions
+        }
+
+    def apply_metadata(self, metadata):
+        self.seq = metadata.get("seq", 0)
+        self.last_timestamp = to_timestamp(metadata.get("last_timestamp"))
+        self.window_open = metadata.get("window_open")
+        self.episode_start = metadata.get("episode_start")
+        self.forecast_timestamp = to_timestamp(metadata.get("forecast_timestamp"))
+        self.reorder_buffer = [list(entry) for entry in metadata.get("reorder_buffer", [])]
+        self.latest_message = metadata.get("latest_message")
+        self.late_insertions = {bucket: metadata.get("late_insertions", {}).get(bucket, 0) for bucket in BUCKETS}
+        self.set_first_data_time(to_timestamp(metadata.get("first_data_time")))
+
+    def histories(self):
+        # Copies of all buckets' histories
+        return {bucket: np.array(self.window_opening_times.timestamps(bucket)) for bucket in self.window_opening_times.buckets}
+
+    def replace_histories(self, histories, metadata):
+        for bucket in self.window_opening_times.buckets:
+            self.window_opening_times.drop(bucket, self.window_opening_times.count(bucket))
+            self.window_opening_times.extend(bucket, histories.get(bucket, ()))
+        self.clusterings = {bucket: self.fit_clustering(bucket) for bucket in BUCKETS}
+        self.apply_metadata(metadata)
+
+    def fit_clustering(self, bucket):
+        # One pass over the stored history, cheaper than keeping the clustering on disk up to date.
+        return IncrementalClustering.fit(self.window_opening_times.timestamps(bucket) % SECONDS_PER_DAY)
+
+    def state_size(self):
+        # Bytes on disk of this device's state
+        size = 0
+        for directory, _, files in os.walk(self.data_path):
+            for name in files:
+                try:
+                    size += os.path.getsize(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+        return size
+
+    def history_fingerprint(self, bucket):
+        # The history is appended in time order and expires from the head, so its length and ends identify it,
+        # together with the number of late window openings inserted in between.
+        timestamps = self.window_opening_times.timestamps(bucket)
+        late_insertions = (self.late_insertions[bucket], ) if self.late_insertions[bucket] else ()
+        if len(timestamps) == 0:
+            return (0, ) + late_insertions
+        return (len(timestamps), int(timestamps[0]), int(timestamps[-1])) + late_insertions
+
+    def add_window_opening(self, bucket, seconds):
+        self.window_opening_times.append(bucket, seconds)
+        self.clusterings[bucket].add([seconds % SECONDS_PER_DAY])
+
+    def add_window_openings(self, bucket, seconds):
+        self.window_opening_times.extend(bucket, seconds)
+        self.clusterings[bucket].add(seconds % SECONDS_PER_DAY)
+
+    def insert_window_opening(self, bucket, seconds) -> bool:
+        # A late window opening, before the end of the history. Returns False if the second is recorded already,
+        # e.g. for a message delivered again.
+        history = self.window_opening_times.timestamps(bucket)
+        i = np.searchsorted(history, seconds)
+        if i < len(history) and history[i] == seconds:
+            return False
+        self.window_opening_times.insert(bucket, [seconds])
+        self.clusterings[bucket].add([seconds % SECONDS_PER_DAY])
+        self.late_insertions[bucket] += 1
+        return True
+
+    def reorder(self, utc_ns: int, seq: int, window_open, window: int, max_messages: int):
+        # Holds messages back until one from window nanoseconds later has arrived, or more than max_messages
+        # are held. Returns the released (utc_ns, window_open) in time order.
+        heapq.heappush(self.reorder_buffer, [int(utc_ns), int(seq), window_open])
+        self.latest_message = max(int(utc_ns), self.latest_message or 0)
+        released = []
+        while self.reorder_buffer and (self.reorder_buffer[0][0] <= self.latest_message - window or len(self.reorder_buffer) > max_messages):
+            utc_ns, _, window_open = heapq.heappop(self.reorder_buffer)
+            released.append((utc_ns, window_open))
+        return released
+
+    def expire_window_openings(self, cutoff):
+        for bucket in BUCKETS:
+            expired = self.window_opening_times.prune(bucket, cutoff)
+            self.clusterings[bucket].remove(expired % SECONDS_PER_DAY)
+            self.window_opening_times.drop(DURATION_BUCKETS[bucket], len(expired))
+
+    def update_window_state(self, window_open: bool, bucket, seconds) -> bool:
+        # Returns whether the message is recorded as a window opening.
+        window_open = bool(window_open)
+        opened = window_open and not self.window_open
+        closed = not window_open and bool(self.window_open)
+        self.window_open = window_open
+        if self.opening_event_mode == "episodes":
+            if opened:
+                self.episode_start = [bucket, int(seconds)]
+            elif closed and self.episode_start is not None:
+                self.close_episode(seconds)
+        return window_open if self.opening_event_mode == "all" else opened
+
+    def update_window_states(self, window_open: np.ndarray) -> np.ndarray:
+        # Vectorized update_window_state for the modes that do not track episodes
+        previous = np.concatenate(([bool(self.window_open)], window_open[:-1]))
+        self.window_open = bool(window_open[-1])
+        return window_open.copy() if self.opening_event_mode == "all" else window_open & ~previous
+
+    def close_episode(self, seconds):
+        bucket, start = self.episode_start
+        self.episode_start = None
+        # Only if the start is still the latest entry of its bucket and not expired meanwhile
+        if self.window_opening_times.count(DURATION_BUCKETS[bucket]) == self.window_opening_times.count(bucket) - 1:
+            self.window_opening_times.append(DURATION_BUCKETS[bucket], int(seconds) - start)
+
+    def opening_reduction_ratio(self):
+        if self.open_samples == 0:
+            return 0.0
+        return 1 - self.recorded_openings/self.open_samples
+
+    def set_first_data_time(self, first_data_time: pd.Timestamp):
+        self.first_data_time = first_data_time
+        self.init_phase_handler = InitPhase(self.data_path, self.init_phase_duration, self.first_data_time, self.produce)
+
+    def migrate_window_opening_times(self):
+        # One-time migration of the pickled history used by earlier versions.
+        window_opening_times = load(self.data_path, WINDOW_OPENING_TIMES_FILE)
+        if window_opening_times:
+            for bucket in BUCKETS:
+                timestamps = sorted(window_opening_times.get(bucket, []))
+                self.window_opening_times.extend(bucket, [to_epoch_seconds(ts) for ts in timestamps])
+            logger.info("%s: Migrated %s to %s", self.device_id, WINDOW_OPENING_TIMES_FILE, WINDOW_OPENING_TIMES_DIR)
+        self.window_opening_times.create()
+
+    def save(self):
+        # One atomic commit of history, timestamps and sequence number
+        self.window_opening_times.commit(self.metadata())
+
+    def close(self):
+        self.save()
+        self.window_opening_times.close()
+
+def to_timestamp(value):
+    return None if value is None else pd.Timestamp(value)
+
+def from_timestamp(timestamp: pd.Timestamp):
+    return None if timestamp is None else timestamp.value
+
+def to_epoch_seconds(timestamp: pd.Timestamp):
+    # Rounded to the nearest second like pd.Timestamp.round("1s"), ties to even
+    seconds, remainder = divmod(timestamp.value, 10**9)
+    if remainder > 5*10**8 or (remainder == 5*10**8 and seconds % 2 == 1):
+        seconds += 1
+    return seconds
+
 class Operator(OperatorBase):
     configType = CustomConfig
 
     def init(self, *args, **kwargs):
         super().init(*args, **kwargs)
+        self.setup_state()
+
+    def setup_state(self):
+        # Everything init does beyond wiring up kafka, so the operator can also be driven offline.
         self.data_path = self.config.data_path
         if not os.path.exists(self.data_path):
             os.mkdir(self.data_path)
@@ -78,109 +324,575 @@ class Operator(OperatorBase):
 
         self.confidence_days = int(self.config.confidence_days)
 
+        self.retention = int(float(self.config.retention_days)*SECONDS_PER_DAY) # in seconds
+
         self.contact_sensor = bool(self.config.contact_sensor)
 
-        self.first_data_time = load(self.data_path, FIRST_DATA_FILENAME)
+        self.reorder_window = int(float(self.config.reorder_window)*10**9) # in nanoseconds
+        self.reorder_messages = int(self.config.reorder_messages)
+
+        self.opening_event_mode = str(self.config.opening_event_mode)
+        if self.opening_event_mode not in OPENING_EVENT_MODES:
+            raise ValueError(f"unknown opening_event_mode '{self.opening_event_mode}', expected one of {', '.join(OPENING_EVENT_MODES)}")
 
         self.init_phase_duration = pd.Timedelta(self.config.init_phase_length, self.config.init_phase_level)        
-        self.init_phase_handler = InitPhase(self.data_path, self.init_phase_duration, self.first_data_time, self.produce)
         value = {
             "stopping_time": self.prepare_output_timestamp(pd.Timestamp.now()),
             "timestamp": self.prepare_output_timestamp(pd.Timestamp.now())
         }
         #self.init_phase_handler.send_first_init_msg(value)
 
-        self.last_timestamp = load(self.data_path, LAST_TIMESTAMP_FILE)
-        
+        # State is modified under this lock and written to disk by the checkpointer thread.
+        self.lock = threading.RLock()
+        self.replaying = False
+        self.recovering = False
+        self.scheduler = None
+        # Number of forecasts still computing per device id
+        self.pending_forecasts = {}
+        self.batcher = None
+        # (device_id, utc_ns, window_open, seq) of the messages waiting for their batch
+        self.batch = []
+        self.horizon_days = int(self.config.horizon_days)
+        # Devices with messages since the last horizon round, and what their last produced horizon depended on
+        self.horizon_devices = set()
+        self.horizon_keys = {}
+        self.devices = DeviceRegistry(os.path.join(self.data_path, DEVICES_DIR), self.open_device, capacity=int(self.config.max_loaded_devices))
+        self.forecast_cache = ForecastCache(os.path.join(self.data_path, FORECAST_CACHE_FILE), max_entries=int(self.config.forecast_cache_size), autosave=False)
+        # Forecasts cached with other parameters must not be reused.
+        self.forecast_parameters = [self.high_confidence_boundary, self.low_confidence_boundary, int(self.config.inertia_buffer), self.confidence_days]
+
+        metrics_file = str(self.config.metrics_file)
+        metrics_port = int(self.config.metrics_port or 0)
+        self.metrics = Metrics(enabled=bool(metrics_file or metrics_port))
+        self.metrics.add_collector(self.collect_device_metrics)
+        self.metrics_exporter = MetricsExporter(self.metrics, file_path=metrics_file, port=metrics_port, interval=float(self.config.metrics_interval))
+        self.metrics_exporter.start()
+
+        self.wal = WriteAheadLog(self.data_path)
+        self.replay_wal()
+        self.checkpointer = Checkpointer(self.checkpoint, self.lock, interval=float(self.config.checkpoint_interval), max_pending=int(self.config.checkpoint_messages))
+        self.checkpointer.start()
+
+        if int(self.config.forecast_workers) > 0:
+            self.scheduler = ForecastScheduler(self.deliver_forecast, self.lock, workers=int(self.config.forecast_workers), max_pending=int(self.config.max_pending_forecasts))
+            self.scheduler.start()
+
+        self.horizon_stopped = threading.Event()
+        self.horizon_thread = None
+        if self.horizon_days > 0:
+            self.horizon_thread = threading.Thread(target=self.produce_horizons_periodically, name="horizon", daemon=True)
+            self.horizon_thread.start()
+
+        if int(self.config.batch_messages) > 1:
+            self.batcher = Checkpointer(self.apply_batch, self.lock, interval=float(self.config.batch_interval), max_pending=int(self.config.batch_messages), name="batcher")
+            self.batcher.start()
+
+    def collect_device_metrics(self, metrics: Metrics):
+        # Gauges of the devices held in memory, evaluated only when the metrics are exported.
+        with self.lock:
+            metrics.set("loaded_devices", len(self.devices.loaded()))
+            for device in self.devices.loaded():
+                for bucket in BUCKETS:
+                    metrics.set("history_length", device.window_opening_times.count(bucket), device=device.device_id, bucket=bucket)
+                metrics.set("state_file_bytes", device.state_size(), device=device.device_id)
+                metrics.set("opening_reduction_ratio", device.opening_reduction_ratio(), device=device.device_id)
+                metrics.set("reorder_buffer_length", len(device.reorder_buffer), device=device.device_id)
+
+    def checkpoint(self):
+        # Called with self.lock held. Devices evicted since the last checkpoint have been saved on close.
+        # Batched messages are in the write-ahead log already and have to be applied before it is truncated.
+        # A device with forecasts still computing keeps its saved state, and the log its messages since, so
+        # they are computed again if the process stops before they are produced, see replay_wal.
+        self.apply_batch()
+        with self.metrics.timer("checkpoint"):
+            retained = []
+            for device in self.devices.loaded():
+                if device.device_id in self.pending_forecasts:
+                    retained.append(device.window_opening_times.metadata.get("seq", 0))
+                else:
+                    device.save()
+            if self.forecast_cache.dirty:
+                self.forecast_cache.save()
+            if retained:
+                self.wal.checkpoint(min(retained), retained_until=self.wal.last_seq)
+            else:
+                self.wal.checkpoint(self.wal.last_seq)
+
+    def replay_wal(self):
+        # Brings the state to where it was when the process stopped, without producing output again. Only the
+        # messages kept by the last checkpoint for computing forecasts produce the ones that are not cached yet.
+        replayed = 0
+        self.recovering = True
+        for record in self.wal.records():
+            self.replaying = record["seq"] > self.wal.retained_until
+            try:
+                if record["seq"] > self.devices.get(record["device_id"]).seq:
+                    output = self.process_message(record["device_id"], record["timestamp"], record["window_open"], record["seq"])
+                    if output:
+                        self.produce_output(output)
+                    replayed += 1
+            except Exception as ex:
+                # It failed when it arrived as well, and must not keep the operator from starting.
+                logger.error("Skipped write-ahead log record %s: %s", record.get("seq"), ex)
+        self.replaying = False
+        self.recovering = False
+        if replayed:
+            logger.info("Replayed %d messages from the write-ahead log", replayed)
+            self.checkpoint()
+
+    def export_state(self, path: str):
+        # All devices' histories and metadata in one columnar file, see storage.write_columnar
+        with self.lock:
+            devices = ((device_id, self.devices.get(device_id)) for device_id in self.devices.device_ids())
+            write_columnar(path, ((device_id, device.histories(), device.metadata()) for device_id, device in devices), BUCKETS + tuple(DURATION_BUCKETS.values()))
+
+    def import_state(self, path: str):
+        # Replaces the state of the devices in the file, other devices are left as they are.
+        with self.lock:
+            n = 0
+            for device_id, histories, metadata in read_columnar(path):
+                # Sequence numbers refer to the write-ahead log of the exporting operator.
+                self.devices.get(device_id).replace_histories(histories, {**metadata, "seq": self.wal.last_seq})
+                n += 1
+            self.checkpoint()
+        logger.info("Imported %d devices from %s", n, path)
+        return n
+
+    def produce_output(self, *args, **kwargs):
+        if not self.replaying:
+            self.produce(*args, **kwargs)
+
+    def open_device(self, device_id, device_path, created):
+        if created and len(self.devices) == 1:
+            # The first device takes over the state of a single-device deployment.
+            for name in LEGACY_STATE:
+                if os.path.exists(os.path.join(self.data_path, name)):
+                    os.replace(os.path.join(self.data_path, name), os.path.join(device_path, name))
+                    logger.info("%s: Took over %s from %s", device_id, name, self.data_path)
+        return DeviceState(device_id, device_path, self.init_phase_duration, self.produce_output, opening_event_mode=self.opening_event_mode)
+
     def stop(self):
         super().stop()
-        save(self.data_path, FIRST_DATA_FILENAME, self.first_data_time)
-        save(self.data_path, LAST_TIMESTAMP_FILE, self.last_timestamp)
+        self.close_state()
+
+    def close_state(self):
+        self.horizon_stopped.set()
+        if self.horizon_thread is not None:
+            self.horizon_thread.join()
+        if self.batcher is not None:
+            self.batcher.stop()
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        self.checkpointer.stop()
+        with self.lock:
+            self.devices.close()
+            self.wal.close()
+        self.metrics_exporter.stop()
 
     def run(self, data: typing.Dict[str, typing.Any], selector: str, device_id, timestamp: datetime.datetime):
-        # Convert to german time and then forget the timezone.
-        current_timestamp = pd.Timestamp(timestamp).tz_localize("Zulu").tz_convert("Europe/Berlin").tz_localize(None)
-
-        if self.first_data_time == None:
-            self.first_data_time = current_timestamp
-            self.init_phase_handler = InitPhase(self.data_path, self.init_phase_duration, self.first_data_time, self.produce)
-        if self.last_timestamp == None:
-            self.last_timestamp = current_timestamp
+        utc_ns = to_utc_nanoseconds(timestamp)
+        if device_id is None:
+            device_id = DEFAULT_DEVICE_ID
+        with self.lock:
+            with self.metrics.timer("wal"):
+                seq = self.wal.append({"device_id": device_id, "timestamp": utc_ns, "window_open": data["window_open"]})
+            if self.batcher is not None:
+                # Outputs of the batch are produced by apply_batch, in the order of the messages.
+                self.batch.append((device_id, utc_ns, data["window_open"], seq))
+                self.batcher.notify()
+                return
+            output = self.process_message(device_id, utc_ns, data["window_open"], seq)
+        self.checkpointer.notify()
+        return output
+
+    def apply_batch(self):
+        # Called with self.lock held, by the batcher once batch_messages have arrived or batch_interval has passed.
+        # Every device's messages are applied in one go, see apply_records, and its state is written at the next checkpoint.
+        batch, self.batch = self.batch, []
+        if len(batch) == 0:
+            return
+        self.metrics.inc("batches_total")
+        outputs = []
+        with self.metrics.timer("batch"):
+            by_device = {}
+            for position, (device_id, utc_ns, window_open, seq) in enumerate(batch):
+                by_device.setdefault(device_id, []).append((utc_ns, position, window_open, seq))
+            for device_id, records in by_device.items():
+                device = self.devices.get(device_id)
+                if self.reorder_window:
+                    # Held back in the order of arrival, like process_message does. Released messages count as part of the
+                    # message releasing them.
+                    records = sorted((released_ns, position, released_window_open, seq) for utc_ns, position, window_open, seq in records
+                                     for released_ns, released_window_open in device.reorder(utc_ns, seq, window_open, self.reorder_window, self.reorder_messages))
+                else:
+                    # In time order, a message that arrived late is applied before the later ones of its batch.
+                    records.sort()
+                device.seq = max(seq for _, _, _, seq in by_device[device_id])
+                if len(records) == 0:
+                    continue
+                utc_ns, positions, window_open, _ = zip(*records)
+                outputs.extend((positions[i], output) for i, output in self.apply_records(device_id, np.array(utc_ns, dtype=np.int64), window_open))
+        self.metrics.inc("messages_total", len(batch))
+        for _, output in sorted(outputs, key=lambda entry: entry[0]):
+            self.produce_output(output)
+        self.checkpointer.notify(len(batch))
+
+    def process_message(self, device_id, utc_ns: int, window_open, seq: int):
+        metrics = self.metrics
+        metrics.inc("messages_total")
+        with metrics.timer("load_state"):
+            device = self.devices.get(device_id)
+        device.seq = seq
+        if self.horizon_days > 0:
+            self.horizon_devices.add(device_id)
+        if self.reorder_window == 0:
+            return self.apply_message(device, utc_ns, window_open)
+        # Outputs of the messages released from the reorder buffer are produced right away.
+        for released_ns, released_window_open in device.reorder(utc_ns, seq, window_open, self.reorder_window, self.reorder_messages):
+            output = self.apply_message(device, released_ns, released_window_open)
+            if output:
+                self.produce_output(output)
+
+    def apply_message(self, device: DeviceState, utc_ns: int, window_open):
+        metrics = self.metrics
+        device_id = device.device_id
+        with metrics.timer("conversion"):
+            # Convert to german time and then forget the timezone.
+            current_timestamp = pd.Timestamp(utc_to_local(utc_ns))
+
+        if device.first_data_time == None:
+            device.set_first_data_time(current_timestamp)
+        first_message = device.last_timestamp == None
+        if first_message:
+            device.last_timestamp = current_timestamp
 
         weekend = self.check_if_weekend(current_timestamp)
 
-        real_time_data = (pd.Timestamp.now(tz="Europe/Berlin").tz_localize(None) - current_timestamp < pd.Timedelta(10, "s"))
+        real_time_data = (time.time_ns() - utc_ns < 10*10**9)
 
         if self.contact_sensor:
-            window_open = not bool(data["window_open"])
+            window_open = not bool(window_open)
         else:
-            window_open = bool(data["window_open"]) 
+            window_open = bool(window_open)
 
         if real_time_data:
-            logger.debug(f"{current_timestamp}:  Window open: {window_open}!")
+            logger.debug("%s: %s:  Window open: %s!", device_id, current_timestamp, window_open)
         else:
-            logger.debug(f"Historic data from: {current_timestamp}:  Window open: {window_open}!")
+            logger.debug("%s: Historic data from: %s:  Window open: %s!", device_id, current_timestamp, window_open)
 
+        # Another message at the time of the latest one is a repetition of it.
+        if current_timestamp < device.last_timestamp or (current_timestamp == device.last_timestamp and not first_message):
+            return self.apply_late_message(device, current_timestamp, window_open)
 
+        bucket = "weekend" if weekend else "weekday"
+        current_seconds = to_epoch_seconds(current_timestamp)
+        recorded = device.update_window_state(window_open, bucket, current_seconds)
         if window_open:
-            window_opening_times = load(self.data_path, WINDOW_OPENING_TIMES_FILE, default=defaultdict(list))
-            if weekend:
-                window_opening_times["weekend"].append(current_timestamp)
-            else:
-                window_opening_times["weekday"].append(current_timestamp)
-            
-            # If data from more than 60 days is stored delete entries.
-            window_opening_times["weekend"] = [ts for ts in window_opening_times["weekend"] if current_timestamp - ts <= pd.Timedelta(60,"d")]
-            window_opening_times["weekday"] = [ts for ts in window_opening_times["weekday"] if current_timestamp - ts <= pd.Timedelta(60,"d")]
-
-
-            save(self.data_path, WINDOW_OPENING_TIMES_FILE, window_opening_times)
-            # window_opening_times is a potentially growing list->it's better to not hold it inside the memory all the time
-            del window_opening_times 
-        
-        outcome = self.check_for_init_phase(current_timestamp)
+            metrics.inc("window_open_events_total")
+            device.open_samples += 1
+        if recorded:
+            metrics.inc("recorded_openings_total")
+            device.recorded_openings += 1
+            with metrics.timer("store"):
+                device.add_window_opening(bucket, current_seconds)
+
+                # Delete entries older than the retention period.
+                device.expire_window_openings(current_seconds - self.retention)
+
+        with metrics.timer("init_phase"):
+            outcome = self.check_for_init_phase(device, current_timestamp)
         if outcome: return  # init phase cuts of normal analysis
 
-        new_day = self.check_for_new_day(self.last_timestamp, current_timestamp)
-        self.last_timestamp = current_timestamp
+        new_day = self.check_for_new_day(device.last_timestamp, current_timestamp)
+        device.last_timestamp = current_timestamp
 
 
-        confidence_list = []
         if new_day:
-            window_opening_times = load(self.data_path, WINDOW_OPENING_TIMES_FILE, default=defaultdict(list))
-            if weekend:
-                considered_timestamps = window_opening_times["weekend"]
-            else:
-                considered_timestamps = window_opening_times["weekday"]
-            
-            if len(considered_timestamps) <= 2:
+            metrics.inc("new_day_runs_total")
+            with metrics.timer("forecast"):
+                return self.compute_forecast(device, current_timestamp, weekend)
+
+    def apply_late_message(self, device: DeviceState, current_timestamp: pd.Timestamp, window_open: bool):
+        # A message from before the day cursor, or repeating the latest one. Neither the cursor nor the window state go back, only a window
+        # opening is inserted into the history. Transitions depend on the order of the messages, in the other
+        # modes late messages are ignored. The latest forecast is recomputed if it depended on the opening.
+        self.metrics.inc("late_messages_total")
+        if not window_open or device.opening_event_mode != "all":
+            return
+        seconds = to_epoch_seconds(current_timestamp)
+        if seconds < to_epoch_seconds(device.last_timestamp) - self.retention:
+            return
+        weekend = self.check_if_weekend(current_timestamp)
+        bucket = "weekend" if weekend else "weekday"
+        with self.metrics.timer("store"):
+            inserted = device.insert_window_opening(bucket, seconds)
+        if not inserted:
+            self.metrics.inc("duplicate_messages_total")
+            return
+        self.metrics.inc("window_open_events_total")
+        self.metrics.inc("recorded_openings_total")
+        device.open_samples += 1
+        device.recorded_openings += 1
+        forecast_timestamp = device.forecast_timestamp
+        if forecast_timestamp is not None and current_timestamp < forecast_timestamp and self.check_if_weekend(forecast_timestamp) == weekend:
+            self.metrics.inc("late_forecast_runs_total")
+            with self.metrics.timer("forecast"):
+                return self.compute_forecast(device, forecast_timestamp, weekend)
+
+    def run_batch(self, device_id, records):
+        # Replays historic data of one device. records is a DataFrame with the columns "timestamp" (UTC) and
+        # "window_open" or an iterable of (timestamp, window_open) pairs in time order. Returns the outputs
+        # run would have returned for the same messages, in order.
+        if isinstance(records, pd.DataFrame):
+            timestamps, window_open = records["timestamp"], records["window_open"]
+        else:
+            records = list(records)
+            if len(records) == 0:
+                return []
+            timestamps, window_open = zip(*records)
+        timestamps = pd.DatetimeIndex(timestamps)
+        if timestamps.tz is not None:
+            timestamps = timestamps.tz_convert(None)
+        if len(timestamps) == 0:
+            return []
+
+        with self.lock:
+            outputs = [output for _, output in self.apply_records(device_id, timestamps.asi8, window_open)]
+            self.metrics.inc("messages_total", len(timestamps))
+            logger.debug("%s: Replayed %d messages, %d forecasts", device_id, len(timestamps), len(outputs))
+            # One write for the whole batch instead of one per message
+            self.checkpoint()
+        return outputs
+
+    def apply_records(self, device_id, utc_ns: np.ndarray, window_open):
+        # Called with self.lock held. Applies messages of one device in time order like process_message would,
+        # but stores their window openings in bulk and treats only the messages starting a new day one by one.
+        # Returns (index, output) of the messages that produced a forecast.
+        timestamps = pd.DatetimeIndex(utc_to_local_array(utc_ns))
+        window_open = np.asarray(window_open, dtype=bool)
+        if self.contact_sensor:
+            window_open = ~window_open
+
+        seconds = timestamps.round("1s").asi8 // 10**9
+        days = timestamps.asi8 // (SECONDS_PER_DAY*10**9)
+        weekend = is_weekend_day(days)
+
+        device = self.devices.get(device_id)
+        if self.horizon_days > 0:
+            self.horizon_devices.add(device_id)
+        if device.first_data_time == None:
+            device.set_first_data_time(timestamps[0])
+        first_message = device.last_timestamp == None
+        if first_message:
+            device.last_timestamp = timestamps[0]
+
+        outputs = []
+        # Messages from before the day cursor come first, they are inserted one by one, like the ones at the cursor
+        # that repeat the latest message.
+        late = int(np.searchsorted(timestamps.asi8, device.last_timestamp.value, side="left" if first_message else "right"))
+        for k in range(late):
+            output = self.apply_late_message(device, timestamps[k], bool(window_open[k]))
+            if output:
+                outputs.append((k, output))
+        if late == len(timestamps):
+            return outputs
+        timestamps, seconds, days, weekend, window_open = timestamps[late:], seconds[late:], days[late:], weekend[late:], window_open[late:]
+
+        stored_until = 0
+        i = 0
+        # While in the init phase every message has to be checked, the day cursor does not move.
+        while i < len(timestamps) and device.init_phase_handler.operator_is_in_init_phase(timestamps[i]):
+            self.add_window_openings(device, seconds[stored_until:i+1], weekend[stored_until:i+1], window_open[stored_until:i+1])
+            stored_until = i+1
+            self.check_for_init_phase(device, timestamps[i])
+            i += 1
+
+        # Afterwards only the messages starting a new day need the full treatment.
+        previous_days = np.concatenate(([device.last_timestamp.value // (SECONDS_PER_DAY*10**9)], days[i:-1]))
+        for b in i + np.flatnonzero(days[i:] > previous_days):
+            self.add_window_openings(device, seconds[stored_until:b+1], weekend[stored_until:b+1], window_open[stored_until:b+1])
+            stored_until = b+1
+            if self.check_for_init_phase(device, timestamps[b]):
+                continue
+            device.last_timestamp = timestamps[b]
+            self.metrics.inc("new_day_runs_total")
+            with self.metrics.timer("forecast"):
+                output = self.compute_forecast(device, timestamps[b], bool(weekend[b]))
+            if output:
+                outputs.append((late + b, output))
+        self.add_window_openings(device, seconds[stored_until:], weekend[stored_until:], window_open[stored_until:])
+        if i < len(timestamps):
+            device.last_timestamp = timestamps[-1]
+        return outputs
+
+    def add_window_openings(self, device: DeviceState, seconds, weekend, window_open):
+        if len(window_open) == 0:
+            return
+        if device.opening_event_mode == "episodes":
+            # Only transitions matter. They are few and handled one by one, so durations stay in step with their starts.
+            previous = np.concatenate(([bool(device.window_open)], window_open[:-1]))
+            recorded = np.zeros(len(window_open), dtype=bool)
+            for i in np.flatnonzero(window_open != previous):
+                bucket = "weekend" if weekend[i] else "weekday"
+                if device.update_window_state(window_open[i], bucket, seconds[i]):
+                    device.add_window_opening(bucket, seconds[i])
+                    recorded[i] = True
+        else:
+            recorded = device.update_window_states(window_open)
+            device.add_window_openings("weekday", seconds[recorded & ~weekend])
+            device.add_window_openings("weekend", seconds[recorded & weekend])
+        n_recorded = int(recorded.sum())
+        device.open_samples += int(window_open.sum())
+        device.recorded_openings += n_recorded
+        self.metrics.inc("window_open_events_total", int(window_open.sum()))
+        self.metrics.inc("recorded_openings_total", n_recorded)
+        if n_recorded == 0:
+            return
+        opening_seconds = seconds[recorded]
+        # Delete entries older than the retention period.
+        device.expire_window_openings(opening_seconds[-1] - self.retention)
+
+    def compute_forecast(self, device: DeviceState, current_timestamp: pd.Timestamp, weekend: bool):
+        bucket = "weekend" if weekend else "weekday"
+        device.forecast_timestamp = current_timestamp
+        # An identical day boundary, e.g. replayed after a restart, gets the stored forecast.
+        cache_key = [device.device_id, str(current_timestamp.date()), bucket, device.history_fingerprint(bucket), self.forecast_parameters]
+        forecast = self.forecast_cache.get(cache_key)
+        if forecast is not None:
+            self.metrics.inc("forecast_cache_hits_total")
+            if self.recovering:
+                # Forecasts are cached when they are produced, replayed messages do not produce them again.
+                return
+            logger.debug("%s: Cached results for next day: %s", device.device_id, forecast)
+            output = [{**entry, "timestamp": self.prepare_output_timestamp(current_timestamp)} for entry in forecast]
+            if self.forecast_async():
+                # Must not overtake forecasts of the device that are still computing
+                self.pending_forecasts[device.device_id] = self.pending_forecasts.get(device.device_id, 0) + 1
+                self.scheduler.put(device.device_id, (device.device_id, None, None), output)
+                return
+            return output
+
+        considered_timestamps = device.window_opening_times.timestamps(bucket)
+
+        if len(considered_timestamps) <= 2:
+            if logger.isEnabledFor(logging.DEBUG):
                 logger.debug({"stopping_time": "Not enough data!",
                                         "confidence_by_spreading": str(0),
                                         "confidence_by_dailyappearance": str(0),
                                         "overall_confidence": str(0),
                                         "timestamp": self.prepare_output_timestamp(current_timestamp)})
-            else:
-                clusters_boundaries, indices = compute_clusters_boundaries(considered_timestamps)
-                current_day = current_timestamp.floor("d")
-                for c in clusters_boundaries.keys():
-                    pair_of_boundaries = clusters_boundaries[c]
-                    ts_in_cluster = [considered_timestamps[i] for i in indices[c]]
-                    confidence_by_spreading = compute_confidence_from_spreading(ts_in_cluster, self.high_confidence_boundary, self.low_confidence_boundary)
-                    confidence_by_daily_appearance = compute_confidence_by_daily_apperance(current_timestamp, considered_timestamps, pair_of_boundaries, confidence_days=self.confidence_days)
-                    overall_confidence = confidence_by_spreading * confidence_by_daily_appearance
-                
-                    confidence_list.append({"stopping_time": self.prepare_output_timestamp(pd.Timestamp.combine(current_day, pair_of_boundaries[0]) - self.inertia_buffer),
-                                            "confidence_by_spreading": str(confidence_by_spreading),
-                                            "confidence by daily_ appearance": str(confidence_by_daily_appearance),
-                                            "overall_confidence": str(overall_confidence),
-                                            "timestamp": self.prepare_output_timestamp(current_timestamp)})
-                del window_opening_times
-                logger.debug(f"Results for next day: {confidence_list}")
-                return [{key: confidence_entry[key] for key in ["stopping_time", "overall_confidence", "timestamp"]} for confidence_entry in confidence_list]
-            
-
-
-
+            return
+
+        if self.forecast_async():
+            self.pending_forecasts[device.device_id] = self.pending_forecasts.get(device.device_id, 0) + 1
+            self.scheduler.submit(device.device_id, (device.device_id, current_timestamp, cache_key), compute_day_forecast_from_seconds, current_timestamp, np.array(considered_timestamps),
+                                  self.high_confidence_boundary, self.low_confidence_boundary, confidence_days=self.confidence_days)
+            return
+
+        forecast = compute_day_forecast(current_timestamp, considered_timestamps, self.high_confidence_boundary, self.low_confidence_boundary, confidence_days=self.confidence_days, clustering=device.clusterings[bucket], timer=self.metrics.timer)
+        return self.finish_forecast(device.device_id, current_timestamp, cache_key, forecast)
+
+    def forecast_horizon(self, device_id, days: int = 7):
+        # Stopping times for every day after the device's latest message up to days ahead, in the format of
+        # the daily output with the time of the latest message as timestamp. Days of a bucket share one
+        # computation, see bucket_schedule.
+        with self.lock:
+            device = self.devices.get(device_id)
+            as_of = device.last_timestamp
+            if as_of is None or device.init_phase_handler.operator_is_in_init_phase(as_of):
+                return []
+            with self.metrics.timer("horizon"):
+                horizon = pd.date_range(as_of.normalize() + pd.Timedelta(days=1), periods=days, freq="D")
+                weekend = is_weekend_day(horizon.asi8 // (SECONDS_PER_DAY*10**9))
+                timestamp = self.prepare_output_timestamp(as_of)
+                schedules = {}
+                output = []
+                for day, day_weekend in zip(horizon, weekend):
+                    bucket = "weekend" if day_weekend else "weekday"
+                    if bucket not in schedules:
+                        schedules[bucket] = self.bucket_schedule(device, bucket, day)
+                    for start, overall_confidence in schedules[bucket]:
+                        # horizon tells the entries apart from the daily output: the number of days ahead of the timestamp's day
+                        output.append({"stopping_time": self.prepare_output_timestamp(pd.Timestamp.combine(day, start) - self.inertia_buffer),
+                                       "overall_confidence": str(overall_confidence),
+                                       "timestamp": timestamp,
+                                       "horizon": (day - as_of.normalize()).days})
+            return output
+
+    def bucket_schedule(self, device: DeviceState, bucket, first_day: pd.Timestamp):
+        # (start, overall confidence) of the clusters of a bucket, valid for its days from first_day on. Daily appearance
+        # is counted on the days before first_day, which have all passed. Cached until the bucket's history changes.
+        cache_key = [device.device_id, "horizon", str(first_day.date()), bucket, device.history_fingerprint(bucket), self.forecast_parameters]
+        schedule = self.forecast_cache.get(cache_key)
+        if schedule is None:
+            self.metrics.inc("horizon_runs_total")
+            considered_timestamps = device.window_opening_times.timestamps(bucket)
+            schedule = []
+            if len(considered_timestamps) > 2:
+                forecast = compute_day_forecast(first_day, considered_timestamps, self.high_confidence_boundary, self.low_confidence_boundary, confidence_days=self.confidence_days, clustering=device.clusterings[bucket])
+                schedule = [[pair_of_boundaries[0].isoformat(), overall_confidence] for pair_of_boundaries, _, _, overall_confidence in forecast]
+            self.forecast_cache.put(cache_key, schedule)
+        return [(datetime.time.fromisoformat(start), overall_confidence) for start, overall_confidence in schedule]
+
+    def horizon_key(self, device: DeviceState):
+        # What the horizon of a device depends on, apart from the time of its latest message
+        as_of = device.last_timestamp
+        if as_of is None:
+            return None
+        return [str(as_of.date()), device.init_phase_handler.operator_is_in_init_phase(as_of)] + [device.history_fingerprint(bucket) for bucket in BUCKETS]
+
+    def produce_horizons_periodically(self):
+        # Only devices with messages since the last round, and of those only the ones whose horizon changed. The lock
+        # is taken per device, so messages are not held up for the whole round.
+        while not self.horizon_stopped.wait(float(self.config.horizon_interval)):
+            with self.lock:
+                device_ids, self.horizon_devices = self.horizon_devices, set()
+            for device_id in sorted(device_ids):
+                if self.horizon_stopped.is_set():
+                    break
+                with self.lock:
+                    key = self.horizon_key(self.devices.get(device_id))
+                    if key is None or self.horizon_keys.get(device_id) == key:
+                        continue
+                    self.horizon_keys[device_id] = key
+                    output = self.forecast_horizon(device_id, self.horizon_days)
+                    if output:
+                        self.produce_output(output)
+
+    def forecast_async(self):
+        # Forecasts recomputed while replaying the write-ahead log are not produced, they are computed right away.
+        return self.scheduler is not None and not self.replaying
+
+    def deliver_forecast(self, context, future):
+        # Called by the scheduler with self.lock held, in order per device. context is (device_id, current_timestamp, cache_key),
+        # the last two are None for a cached forecast.
+        device_id, current_timestamp, cache_key = context
+        self.pending_forecasts[device_id] -= 1
+        if self.pending_forecasts[device_id] == 0:
+            del self.pending_forecasts[device_id]
+        try:
+            output = future.result()
+        except Exception as ex:
+            logger.error("Computing the forecast for %s failed: %s", device_id, ex)
+            return
+        if current_timestamp is not None:
+            output = self.finish_forecast(device_id, current_timestamp, cache_key, output)
+        if output:
+            self.produce_output(output)
+
+    def finish_forecast(self, device_id, current_timestamp: pd.Timestamp, cache_key, forecast):
+        self.metrics.inc("clusters_found_total", len(forecast))
+        current_day = current_timestamp.floor("d")
+        confidence_list = []
+        for pair_of_boundaries, confidence_by_spreading, confidence_by_daily_appearance, overall_confidence in forecast:
+            confidence_list.append({"stopping_time": self.prepare_output_timestamp(pd.Timestamp.combine(current_day, pair_of_boundaries[0]) - self.inertia_buffer),
+                                    "confidence_by_spreading": str(confidence_by_spreading),
+                                    "confidence by daily_ appearance": str(confidence_by_daily_appearance),
+                                    "overall_confidence": str(overall_confidence),
+                                    "timestamp": self.prepare_output_timestamp(current_timestamp)})
+        logger.debug("%s: Results for next day: %s", device_id, confidence_list)
+        self.forecast_cache.put(cache_key, [{key: confidence_entry[key] for key in ["stopping_time", "overall_confidence"]} for confidence_entry in confidence_list])
+        return [{key: confidence_entry[key] for key in ["stopping_time", "overall_confidence", "timestamp"]} for confidence_entry in confidence_list]
 
     def check_for_new_day(self, last_timestamp: pd.Timestamp, current_timestamp: pd.Timestamp):
         if current_timestamp.date() > last_timestamp.date():
@@ -194,26 +906,25 @@ class Operator(OperatorBase):
         else:
             return True
         
-    def check_for_init_phase(self, current_timestamp: pd.Timestamp):
+    def check_for_init_phase(self, device: DeviceState, current_timestamp: pd.Timestamp):
         init_value = {
             "stopping_time": current_timestamp.isoformat(),
             "overall_confidence": None,
             "timestamp": current_timestamp.isoformat()
         }
-        if self.init_phase_handler.operator_is_in_init_phase(current_timestamp):
-            logger.debug(self.init_phase_handler.generate_init_msg(current_timestamp, init_value))
-            return self.init_phase_handler.generate_init_msg(current_timestamp, init_value)
+        if device.init_phase_handler.operator_is_in_init_phase(current_timestamp):
+            logger.debug(device.init_phase_handler.generate_init_msg(current_timestamp, init_value))
+            return device.init_phase_handler.generate_init_msg(current_timestamp, init_value)
 
-        if self.init_phase_handler.init_phase_needs_to_be_reset():
-            logger.debug(self.init_phase_handler.reset_init_phase(init_value))
-            return self.init_phase_handler.reset_init_phase(init_value)
+        if device.init_phase_handler.init_phase_needs_to_be_reset():
+            logger.debug(device.init_phase_handler.reset_init_phase(init_value))
+            return device.init_phase_handler.reset_init_phase(init_value)
 
         return False
     
     def prepare_output_timestamp(self, current_timestamp: pd.Timestamp):
-        current_timestamp = current_timestamp.tz_localize("Europe/Berlin").tz_convert("Zulu")
-        current_timestamp_string = current_timestamp.isoformat().replace('+00:00', 'Z')
-        return current_timestamp_string
+        # current_timestamp is german time without timezone
+        return format_utc(local_to_utc(current_timestamp.value))
 
 from operator_lib.operator_lib import OperatorLib
 if __name__ == "__main__":
@@ -1,17 +1,27 @@
 from confluent_kafka import Producer
 import socket
-import json 
+import json
+import sys
+
+from synthetic import generate_room_events
+
+# python produce_test_data.py [rooms] [days]
+ROOMS = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+DAYS = int(sys.argv[2]) if len(sys.argv) > 2 else 28
+# The operator's default, the sensor reports whether the contact is closed
+CONTACT_SENSOR = True
 
 conf = {'bootstrap.servers': 'localhost:29092',
         'client.id': socket.gethostname()}
 
 producer = Producer(conf)
 
-producer.produce("analytics", key="key", value=json.dumps({
-    "device_id": "id",
-    "service_id": "analytics",
-    "Humidity": 10,
-    "Humidity_Time": "2024-04-22T14:00:25.737774",
-    "time": "2024-04-23T14:00:25.737774"
-}))
+for device_id, timestamp, window_open in generate_room_events(rooms=ROOMS, days=DAYS):
+    producer.produce("analytics", key=device_id, value=json.dumps({
+        "device_id": device_id,
+        "service_id": "analytics",
+        "window_open": int(window_open != CONTACT_SENSOR),
+        "time": timestamp.isoformat()
+    }))
+    producer.poll(0)
 producer.flush()
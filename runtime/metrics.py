@@ -0,0 +1,158 @@
+__all__ = ("Metrics", "MetricsExporter")
+
+import collections
+import contextlib
+import http.server
+import os
+import threading
+import time
+
+_NULL_TIMER = contextlib.nullcontext()
+
+
+class _Timer:
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+
+
+class Metrics:
+    """Stage timers, counters and gauges rendered in the Prometheus text format.
+
+    When disabled, timer() hands out a shared no-op context manager and inc/set
+    return right away, so instrumented code costs one method call per stage.
+    Collectors are called only when rendering, they set gauges that are too
+    expensive to keep current on the hot path.
+    """
+
+    def __init__(self, enabled: bool = True, prefix: str = "automatic_heating"):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.__lock = threading.Lock()
+        self.__timers = collections.defaultdict(lambda: [0, 0.0, 0.0])  # stage -> [count, sum, max]
+        self.__counters = collections.defaultdict(float)
+        self.__gauges = {}
+        self.__collectors = []
+
+    def timer(self, stage: str):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def observe(self, stage: str, seconds: float):
+        with self.__lock:
+            timer = self.__timers[stage]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        with self.__lock:
+            self.__counters[(name, tuple(sorted(labels.items())))] += value
+
+    def set(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        with self.__lock:
+            self.__gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def add_collector(self, collector):
+        self.__collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self.__collectors:
+            collector(self)
+        with self.__lock:
+            timers = {stage: list(timer) for stage, timer in self.__timers.items()}
+            counters = dict(self.__counters)
+            gauges = dict(self.__gauges)
+
+        lines = []
+        if timers:
+            lines.append(f"# TYPE {self.prefix}_stage_seconds summary")
+            for stage, (count, total, _) in sorted(timers.items()):
+                lines.append(f'{self.prefix}_stage_seconds_count{{stage="{stage}"}} {count}')
+                lines.append(f'{self.prefix}_stage_seconds_sum{{stage="{stage}"}} {total:.9f}')
+            lines.append(f"# TYPE {self.prefix}_stage_seconds_max gauge")
+            for stage, (_, _, maximum) in sorted(timers.items()):
+                lines.append(f'{self.prefix}_stage_seconds_max{{stage="{stage}"}} {maximum:.9f}')
+        for metrics, metric_type in ((counters, "counter"), (gauges, "gauge")):
+            typed = set()
+            for (name, labels), value in sorted(metrics.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {self.prefix}_{name} {metric_type}")
+                    typed.add(name)
+                lines.append(f"{self.prefix}_{name}{self.__format_labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def __format_labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class MetricsExporter:
+    # Writes the metrics to a file every interval seconds and/or serves them at http://<host>:<port>/metrics.
+    def __init__(self, metrics: Metrics, file_path: str = "", port: int = 0, interval: float = 15.0):
+        self.metrics = metrics
+        self.file_path = file_path
+        self.port = port
+        self.interval = interval
+        self.__stopped = threading.Event()
+        self.__thread = None
+        self.__server = None
+
+    def start(self):
+        if self.file_path:
+            self.__thread = threading.Thread(target=self.__write_periodically, name="metrics-writer", daemon=True)
+            self.__thread.start()
+        if self.port:
+            metrics = self.metrics
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.rstrip("/") not in ("", "/metrics"):
+                        self.send_error(404)
+                        return
+                    body = metrics.render().encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self.__server = http.server.ThreadingHTTPServer(("", self.port), Handler)
+            threading.Thread(target=self.__server.serve_forever, name="metrics-server", daemon=True).start()
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join()
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+
+    def write(self):
+        tmp_path = self.file_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.metrics.render())
+        os.replace(tmp_path, self.file_path)
+
+    def __write_periodically(self):
+        while not self.__stopped.wait(self.interval):
+            self.write()
+        self.write()
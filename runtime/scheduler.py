@@ -0,0 +1,101 @@
+__all__ = ("ForecastScheduler", )
+
+import collections
+import concurrent.futures
+import multiprocessing
+import threading
+import typing
+import zlib
+
+
+class ForecastScheduler:
+    """Runs tasks on worker processes, sharded by a key such as the device id.
+
+    Every shard is a single process executing its tasks in submission order, and
+    results are delivered per shard in that order, so results of one key never
+    overtake each other. Results are handed to on_result(context, future) by a
+    background thread or by submit, always while holding lock. When max_pending
+    tasks are in flight, submit waits for the oldest one to finish.
+    """
+
+    def __init__(self, on_result: typing.Callable, lock, workers: int = 2, max_pending: int = 1000, start_method: str = "spawn"):
+        self.on_result = on_result
+        self.lock = lock
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        context = multiprocessing.get_context(start_method)
+        self.__executors = [concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) for _ in range(self.workers)]
+        self.__queues = [collections.deque() for _ in range(self.workers)]
+        self.__pending = 0
+        self.__done = threading.Event()
+        self.__stopped = False
+        self.__thread = None
+
+    @property
+    def pending(self) -> int:
+        return self.__pending
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, name="forecast-scheduler", daemon=True)
+        self.__thread.start()
+
+    def submit(self, key: str, context, fn: typing.Callable, *args, **kwargs):
+        # Called with lock held. fn and its arguments are pickled, they should be module level functions and arrays.
+        shard = self.shard(key)
+        self.__wait_for_capacity()
+        future = self.__executors[shard].submit(fn, *args, **kwargs)
+        self.__enqueue(shard, context, future)
+
+    def put(self, key: str, context, result):
+        # Called with lock held. Delivers an already known result in order with the tasks submitted for key.
+        self.__wait_for_capacity()
+        future = concurrent.futures.Future()
+        future.set_result(result)
+        self.__enqueue(self.shard(key), context, future)
+
+    def deliver(self):
+        # Called with lock held. Hands over the finished results at the head of every shard.
+        for queue in self.__queues:
+            while queue and queue[0][1].done():
+                context, future = queue.popleft()
+                self.__pending -= 1
+                self.on_result(context, future)
+
+    def flush(self):
+        # Called with lock held. Waits for all tasks in flight and delivers their results.
+        concurrent.futures.wait([future for queue in self.__queues for _, future in queue])
+        self.deliver()
+
+    def stop(self):
+        # Waits for all tasks and delivers their results.
+        self.__stopped = True
+        self.__done.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        with self.lock:
+            self.flush()
+        for executor in self.__executors:
+            executor.shutdown()
+
+    def shard(self, key: str) -> int:
+        # Stable across processes and restarts, unlike hash()
+        return zlib.crc32(key.encode()) % self.workers
+
+    def __enqueue(self, shard, context, future):
+        self.__queues[shard].append((context, future))
+        self.__pending += 1
+        future.add_done_callback(lambda _: self.__done.set())
+
+    def __wait_for_capacity(self):
+        while self.__pending >= self.max_pending:
+            heads = [queue[0][1] for queue in self.__queues if queue]
+            concurrent.futures.wait(heads, return_when=concurrent.futures.FIRST_COMPLETED)
+            self.deliver()
+
+    def __run(self):
+        while not self.__stopped:
+            self.__done.wait()
+            self.__done.clear()
+            with self.lock:
+                self.deliver()
@@ -0,0 +1,124 @@
+__all__ = ("to_utc_nanoseconds", "utc_to_local", "utc_to_local_array", "local_to_utc", "format_utc")
+
+import bisect
+import calendar
+import datetime
+import time
+import zoneinfo
+
+import numpy as np
+
+NS_PER_SECOND = 10**9
+NS_PER_HOUR = 3600*NS_PER_SECOND
+NS_PER_DAY = 24*NS_PER_HOUR
+
+# Offsets of Europe/Berlin are read from the tz database, once per year and then cached.
+TIMEZONE = zoneinfo.ZoneInfo("Europe/Berlin")
+
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+_transitions = {}
+# The interval of constant offset the last lookup fell into: (start, end, offset) in UTC nanoseconds
+_current_interval = (0, 0, 0)
+
+
+def _year_start(year):
+    return (datetime.date(year, 1, 1).toordinal() - _EPOCH_ORDINAL)*NS_PER_DAY
+
+def _utc_offset(utc_ns):
+    utc = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(microseconds=utc_ns // 1000)
+    return TIMEZONE.utcoffset(utc.astimezone(TIMEZONE)) // datetime.timedelta(microseconds=1)*1000
+
+def _year_transitions(year):
+    # (starts, offsets) of the intervals of constant offset in a year, the first one starts on new year.
+    # The offset is sampled once a day, a change is narrowed down to the second by bisection.
+    if year not in _transitions:
+        year_start, year_end = _year_start(year), _year_start(year + 1)
+        starts, offsets = [year_start], [_utc_offset(year_start)]
+        low = year_start
+        for sample in list(range(year_start + NS_PER_DAY, year_end, NS_PER_DAY)) + [year_end - NS_PER_SECOND]:
+            offset = _utc_offset(sample)
+            if offset != offsets[-1]:
+                high = sample
+                while high - low > NS_PER_SECOND:
+                    middle = low + (high - low) // 2 // NS_PER_SECOND*NS_PER_SECOND
+                    if _utc_offset(middle) == offsets[-1]:
+                        low = middle
+                    else:
+                        high = middle
+                starts.append(high)
+                offsets.append(offset)
+            low = sample
+        _transitions[year] = (starts, offsets)
+    return _transitions[year]
+
+def _interval(utc_ns):
+    year = time.gmtime(utc_ns // NS_PER_SECOND).tm_year
+    starts, offsets = _year_transitions(year)
+    i = bisect.bisect_right(starts, utc_ns) - 1
+    end = starts[i + 1] if i + 1 < len(starts) else _year_start(year + 1)
+    return starts[i], end, offsets[i]
+
+def _offset(utc_ns):
+    global _current_interval
+    start, end, offset = _current_interval
+    if start <= utc_ns < end:
+        return offset
+    _current_interval = _interval(utc_ns)
+    return _current_interval[2]
+
+
+def to_utc_nanoseconds(timestamp) -> int:
+    # Naive timestamps are taken as UTC, like the messages' timestamps are.
+    if isinstance(timestamp, datetime.datetime):
+        utc_ns = calendar.timegm(timestamp.timetuple())*NS_PER_SECOND + timestamp.microsecond*1000
+        if timestamp.tzinfo is not None:
+            utc_ns -= timestamp.utcoffset() // datetime.timedelta(microseconds=1)*1000
+        # pd.Timestamp is a datetime subclass that can carry nanoseconds
+        return utc_ns + getattr(timestamp, "nanosecond", 0)
+    if isinstance(timestamp, np.datetime64):
+        return int(timestamp.astype("datetime64[ns]").view(np.int64))
+    import pandas as pd
+    timestamp = pd.Timestamp(timestamp)
+    if timestamp.tz is not None:
+        timestamp = timestamp.tz_convert(None)
+    return timestamp.value
+
+def utc_to_local(utc_ns: int) -> int:
+    return utc_ns + _offset(utc_ns)
+
+def utc_to_local_array(utc_ns) -> np.ndarray:
+    utc_ns = np.asarray(utc_ns, dtype=np.int64)
+    if len(utc_ns) == 0:
+        return utc_ns.copy()
+    first_year = time.gmtime(int(utc_ns.min()) // NS_PER_SECOND).tm_year
+    last_year = time.gmtime(int(utc_ns.max()) // NS_PER_SECOND).tm_year
+    starts, offsets = [], []
+    for year in range(first_year, last_year + 1):
+        year_starts, year_offsets = _year_transitions(year)
+        starts += year_starts
+        offsets += year_offsets
+    # The offset of the last interval that started before a timestamp
+    interval = np.searchsorted(np.array(starts, dtype=np.int64), utc_ns, side="right") - 1
+    return utc_ns + np.array(offsets, dtype=np.int64)[interval]
+
+def local_to_utc(local_ns: int) -> int:
+    # Ambiguous local times (the repeated hour in autumn) resolve to the first occurrence, nonexistent
+    # ones (the skipped hour in spring) keep the offset from before the transition, like datetime's fold=0.
+    offset_before = _offset(local_ns - 14*NS_PER_HOUR)
+    offset_after = _offset(local_ns + 14*NS_PER_HOUR)
+    if offset_before == offset_after:
+        return local_ns - offset_before
+    for offset in (offset_before, offset_after):
+        if _offset(local_ns - offset) == offset:
+            return local_ns - offset
+    return local_ns - offset_before
+
+def format_utc(utc_ns: int) -> str:
+    # Same as pd.Timestamp(utc_ns).isoformat() with a "Z" suffix
+    seconds, nanoseconds = divmod(utc_ns, NS_PER_SECOND)
+    formatted = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds))
+    if nanoseconds % 1000:
+        formatted += f".{nanoseconds:09d}"
+    elif nanoseconds:
+        formatted += f".{nanoseconds // 1000:06d}"
+    return formatted + "Z"
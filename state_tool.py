@@ -0,0 +1,49 @@
+"""
+   Copyright 2022 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   Moves the state of all devices between operators. The operator must not be running.
+
+       python state_tool.py export <data_path> <file.npz>
+       python state_tool.py import <data_path> <file.npz>
+"""
+
+import sys
+
+from main import Operator, CustomConfig
+
+USAGE = "usage: python state_tool.py export|import <data_path> <file.npz>"
+
+
+def open_operator(data_path):
+    operator = Operator()
+    operator.config = CustomConfig({"data_path": data_path})
+    operator.setup_state()
+    return operator
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] not in ("export", "import"):
+        print(USAGE, file=sys.stderr)
+        sys.exit(2)
+    command, data_path, path = sys.argv[1:]
+    operator = open_operator(data_path)
+    try:
+        if command == "export":
+            operator.export_state(path)
+            print(f"Exported {len(operator.devices)} devices to {path}")
+        else:
+            print(f"Imported {operator.import_state(path)} devices from {path}")
+    finally:
+        operator.close_state()
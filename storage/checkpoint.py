@@ -0,0 +1,132 @@
+__all__ = ("WriteAheadLog", "Checkpointer")
+
+import json
+import os
+import threading
+import typing
+
+CHECKPOINT_FILE = "checkpoint.json"
+
+
+class WriteAheadLog:
+    """Json lines log of input records, numbered by a sequence number.
+
+    Records are handed to the OS on append but not fsynced, so they survive a
+    crash of the process. checkpoint(seq) atomically stores that everything up
+    to seq is persisted elsewhere and drops those records from the log. Records
+    kept by a checkpoint before the last appended one can be told apart by
+    retained_until.
+    """
+
+    def __init__(self, path: str, filename: str = "wal.jsonl"):
+        self.path = path
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.log_path = os.path.join(self.path, filename)
+        self.checkpoint_seq, self.retained_until = self.__read_checkpoint()
+        self.last_seq = self.checkpoint_seq
+        for record in self.records():
+            self.last_seq = record["seq"]
+        self.__file = open(self.log_path, "a")
+
+    def records(self) -> typing.Iterator[dict]:
+        # Records after the last checkpoint. A torn last line of a crashed process is skipped.
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if record["seq"] > self.checkpoint_seq:
+                    yield record
+
+    def append(self, record: dict) -> int:
+        self.last_seq += 1
+        self.__file.write(json.dumps({"seq": self.last_seq, **record}) + "\n")
+        self.__file.flush()
+        return self.last_seq
+
+    def checkpoint(self, seq: int, retained_until: int = 0):
+        # retained_until is the last seq of the records after seq that were still in the log when it was checkpointed.
+        path = os.path.join(self.path, CHECKPOINT_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"seq": seq, "retained_until": retained_until}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self.checkpoint_seq = seq
+        self.retained_until = retained_until
+        self.__file.close()
+        if seq >= self.last_seq:
+            self.__file = open(self.log_path, "w")
+            return
+        # Only the records after seq are kept, the log does not grow while some are always retained.
+        tmp_path = self.log_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for record in self.records():
+                f.write(json.dumps(record) + "\n")
+        os.replace(tmp_path, self.log_path)
+        self.__file = open(self.log_path, "a")
+
+    def close(self):
+        self.__file.close()
+
+    def __read_checkpoint(self):
+        path = os.path.join(self.path, CHECKPOINT_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                checkpoint = json.load(f)
+            return checkpoint["seq"], checkpoint.get("retained_until", 0)
+        return 0, 0
+
+
+class Checkpointer:
+    """Runs checkpoint on a background thread.
+
+    A checkpoint is taken every interval seconds, as soon as max_pending
+    notifications have accumulated and once more on stop. checkpoint runs while
+    holding lock, the lock the state is modified under.
+    """
+
+    def __init__(self, checkpoint: typing.Callable, lock, interval: float = 30.0, max_pending: int = 10000, name: str = "checkpointer"):
+        self.checkpoint = checkpoint
+        self.lock = lock
+        self.interval = interval
+        self.max_pending = max(1, max_pending)
+        self.pending = 0
+        self.__wakeup = threading.Event()
+        self.__stopped = False
+        self.__thread = None
+        self.name = name
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, name=self.name, daemon=True)
+        self.__thread.start()
+
+    def notify(self, n: int = 1):
+        self.pending += n
+        if self.pending >= self.max_pending:
+            self.__wakeup.set()
+
+    def stop(self):
+        self.__stopped = True
+        self.__wakeup.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        else:
+            self.__checkpoint()
+
+    def __checkpoint(self):
+        with self.lock:
+            self.pending = 0
+            self.checkpoint()
+
+    def __run(self):
+        while not self.__stopped:
+            self.__wakeup.wait(self.interval)
+            self.__wakeup.clear()
+            self.__checkpoint()
@@ -0,0 +1,66 @@
+__all__ = ("write_columnar", "read_columnar")
+
+import json
+import os
+import typing
+
+import numpy as np
+
+COLUMNAR_FORMAT = "automatic_heating_state"
+COLUMNAR_VERSION = 1
+
+
+def write_columnar(path: str, devices: typing.Iterable, buckets: typing.Sequence[str]):
+    """Writes the state of many devices to one .npz file.
+
+    devices yields (device_id, {bucket: int64 array}, metadata dict). Every bucket
+    becomes two columns, <bucket>.values with the histories of all devices one after
+    another and <bucket>.offsets where device i's history starts. Metadata is stored
+    as one json document per device. The schema column describes the layout.
+    """
+    device_ids = []
+    metadata = []
+    values = {bucket: [] for bucket in buckets}
+    lengths = {bucket: [] for bucket in buckets}
+    for device_id, histories, device_metadata in devices:
+        device_ids.append(device_id)
+        metadata.append(json.dumps(device_metadata))
+        for bucket in buckets:
+            history = np.asarray(histories.get(bucket, ()), dtype=np.int64)
+            values[bucket].append(history)
+            lengths[bucket].append(len(history))
+
+    schema = {
+        "format": COLUMNAR_FORMAT,
+        "version": COLUMNAR_VERSION,
+        "devices": len(device_ids),
+        "buckets": list(buckets),
+        "units": "seconds since the epoch, german local time"
+    }
+    columns = {
+        "schema": np.array(json.dumps(schema)),
+        "device_ids": np.array(device_ids, dtype=str),
+        "metadata": np.array(metadata, dtype=str)
+    }
+    for bucket in buckets:
+        columns[f"{bucket}.values"] = np.concatenate(values[bucket]) if values[bucket] else np.empty(0, dtype=np.int64)
+        columns[f"{bucket}.offsets"] = np.concatenate(([0], np.cumsum(lengths[bucket], dtype=np.int64)))
+
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, **columns)
+    os.replace(tmp_path, path)
+
+
+def read_columnar(path: str) -> typing.Iterator[tuple]:
+    # Yields (device_id, {bucket: int64 array}, metadata dict) per device, like write_columnar takes them.
+    with np.load(path) as stored:
+        schema = json.loads(str(stored["schema"]))
+        if schema.get("format") != COLUMNAR_FORMAT or schema.get("version", 0) > COLUMNAR_VERSION:
+            raise ValueError(f"unsupported state file '{path}': {schema.get('format')} version {schema.get('version')}")
+        device_ids = stored["device_ids"]
+        metadata = stored["metadata"]
+        columns = {bucket: (stored[f"{bucket}.values"], stored[f"{bucket}.offsets"]) for bucket in schema["buckets"]}
+
+    for i, device_id in enumerate(device_ids):
+        histories = {bucket: values[offsets[i]:offsets[i + 1]] for bucket, (values, offsets) in columns.items()}
+        yield str(device_id), histories, json.loads(str(metadata[i]))
@@ -0,0 +1,86 @@
+__all__ = ("DeviceRegistry", )
+
+import collections
+import hashlib
+import json
+import os
+import typing
+
+INDEX_FILE = "index.json"
+
+
+class DeviceRegistry:
+    """Lazily loaded per-device state with LRU eviction.
+
+    Every device gets its own directory below path. index.json maps device ids to
+    directories, so devices can be listed without touching their state. At most
+    capacity states are held in memory, the least recently used one is closed
+    when another device has to be loaded.
+    """
+
+    def __init__(self, path: str, open_device: typing.Callable, capacity: int = 1000):
+        self.path = path
+        self.open_device = open_device
+        self.capacity = max(1, capacity)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        self.__index = self.__read_index()
+        self.__loaded = collections.OrderedDict()
+
+    def get(self, device_id: str):
+        state = self.__loaded.get(device_id)
+        if state is not None:
+            self.__loaded.move_to_end(device_id)
+            return state
+
+        created = device_id not in self.__index
+        if created:
+            self.__index[device_id] = self.directory_name(device_id)
+            os.makedirs(self.device_path(device_id), exist_ok=True)
+            self.__write_index()
+        state = self.open_device(device_id, self.device_path(device_id), created)
+        self.__loaded[device_id] = state
+        while len(self.__loaded) > self.capacity:
+            _, evicted = self.__loaded.popitem(last=False)
+            evicted.close()
+        return state
+
+    def device_ids(self):
+        return list(self.__index.keys())
+
+    def loaded(self):
+        return list(self.__loaded.values())
+
+    def device_path(self, device_id: str):
+        return os.path.join(self.path, self.__index.get(device_id) or self.directory_name(device_id))
+
+    def close(self):
+        while self.__loaded:
+            _, state = self.__loaded.popitem(last=False)
+            state.close()
+
+    def __len__(self):
+        return len(self.__index)
+
+    def __contains__(self, device_id):
+        return device_id in self.__index
+
+    @staticmethod
+    def directory_name(device_id: str):
+        # Device ids contain characters like ':' that are not safe in file names.
+        return hashlib.sha1(device_id.encode()).hexdigest()
+
+    def __read_index(self):
+        path = os.path.join(self.path, INDEX_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+        return {}
+
+    def __write_index(self):
+        path = os.path.join(self.path, INDEX_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.__index, f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,218 @@
+__all__ = ("EventStore", )
+
+import json
+import os
+
+import numpy as np
+
+from .sliding_window import SlidingWindow
+
+META_FILE = "meta.json"
+STORE_VERSION = 1
+
+# Compaction is triggered once the pruned head of a segment is both larger than
+# this and larger than the live part, so rewriting a segment is amortized O(1) per event.
+COMPACTION_THRESHOLD = 4096
+
+
+class EventStore:
+    """Append-only store of int64 epoch seconds with one segment file per bucket.
+
+    Segments are only ever appended to. Expired entries are dropped by moving the
+    per-bucket offset stored in the meta file; the segment is rewritten under a new
+    generation number once enough dead entries have accumulated, or when a late
+    entry was inserted before its end.
+
+    The live part of a bucket is held in a SlidingWindow once accessed. Appends and
+    prunes only change the window until commit, which writes them together with a
+    metadata dict and makes them durable with a single meta file update. Anything
+    written after the last commit is discarded when the store is opened.
+    """
+
+    def __init__(self, path: str, buckets=("weekday", "weekend"), compaction_threshold: int = COMPACTION_THRESHOLD):
+        self.path = path
+        self.buckets = tuple(buckets)
+        self.compaction_threshold = compaction_threshold
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        self.__meta = self.__read_meta()
+        self.__windows = {}
+        # Number of entries at the tail of each window that are not in the segment yet
+        self.__pending = {bucket: 0 for bucket in self.buckets}
+        # Buckets with entries inserted before their committed part, rewritten on commit
+        self.__rewrite = set()
+        self.__dirty = False
+        self.__discard_uncommitted()
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, META_FILE))
+
+    def create(self):
+        # Marks the store as initialized, e.g. after a migration has been written.
+        self.__dirty = True
+        self.commit()
+
+    @property
+    def metadata(self) -> dict:
+        # The metadata passed to the last commit
+        return self.__meta["metadata"]
+
+    @property
+    def dirty(self) -> bool:
+        return self.__dirty
+
+    def append(self, bucket: str, seconds: int):
+        self.extend(bucket, np.array([seconds], dtype=np.int64))
+
+    def extend(self, bucket: str, seconds):
+        seconds = np.asarray(seconds, dtype=np.int64)
+        if len(seconds) == 0:
+            return
+        self.__window(bucket).extend(seconds)
+        self.__pending[bucket] += len(seconds)
+        self.__dirty = True
+        if not self.exists():
+            self.__write_meta()
+
+    def insert(self, bucket: str, seconds):
+        # Inserts late entries in time order. Entries landing in the committed part of the
+        # segment make the next commit rewrite it like a compaction.
+        seconds = np.asarray(seconds, dtype=np.int64)
+        if len(seconds) == 0:
+            return
+        window = self.__window(bucket)
+        committed = len(window) - self.__pending[bucket]
+        if window.insert(seconds) < committed:
+            self.__rewrite.add(bucket)
+        else:
+            self.__pending[bucket] += len(seconds)
+        self.__dirty = True
+        if not self.exists():
+            self.__write_meta()
+
+    def timestamps(self, bucket: str) -> np.ndarray:
+        # Read-only view of the live part of a bucket, not copied and not changed by later appends or prunes.
+        return self.__window(bucket).view()
+
+    def count(self, bucket: str) -> int:
+        return len(self.__window(bucket))
+
+    def prune(self, bucket: str, cutoff: int) -> np.ndarray:
+        # Drops all entries older than cutoff and returns them. Segments are time ordered.
+        expired = self.__window(bucket).expire(cutoff)
+        if len(expired):
+            self.__dirty = True
+        return expired
+
+    def drop(self, bucket: str, n: int) -> np.ndarray:
+        # Drops the n oldest entries and returns them.
+        dropped = self.__window(bucket).drop(n)
+        if len(dropped):
+            self.__dirty = True
+        return dropped
+
+    def commit(self, metadata: dict = None):
+        # Writes pending appends, compacts and atomically stores offsets, lengths and metadata.
+        if metadata is not None and metadata != self.__meta["metadata"]:
+            self.__meta["metadata"] = metadata
+            self.__dirty = True
+        if not self.__dirty:
+            return
+        obsolete = []
+        for bucket, window in self.__windows.items():
+            if bucket in self.__rewrite:
+                self.__pending[bucket] = 0
+                obsolete.append(self.__compact(bucket))
+                continue
+            live = window.view()
+            # Pending entries may have been dropped again before being written.
+            new = live[len(live) - min(self.__pending[bucket], len(live)):]
+            if len(new):
+                # Opened per commit, a handle per bucket of every loaded device would run out of file descriptors.
+                with open(self.__segment_path(bucket), "ab") as f:
+                    f.write(new.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                self.__meta["lengths"][bucket] += len(new)
+            self.__pending[bucket] = 0
+            self.__meta["offsets"][bucket] = self.__meta["lengths"][bucket] - len(live)
+
+            offset = self.__meta["offsets"][bucket]
+            if offset > self.compaction_threshold and offset > len(live):
+                obsolete.append(self.__compact(bucket))
+        # The meta file is the commit point, old generations are only removed afterwards.
+        self.__write_meta()
+        self.__dirty = False
+        self.__rewrite.clear()
+        for path in obsolete:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def close(self):
+        self.commit()
+        self.__windows = {}
+
+    def __compact(self, bucket: str):
+        live = np.array(self.timestamps(bucket))
+        old_path = self.__segment_path(bucket)
+
+        self.__meta["generations"][bucket] += 1
+        self.__meta["offsets"][bucket] = 0
+        self.__meta["lengths"][bucket] = len(live)
+        with open(self.__segment_path(bucket), "wb") as f:
+            f.write(live.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        return old_path
+
+    def __window(self, bucket: str):
+        if bucket not in self.__windows:
+            path = self.__segment_path(bucket)
+            offset, length = self.__meta["offsets"][bucket], self.__meta["lengths"][bucket]
+            live = np.empty(0, dtype=np.int64)
+            if length > offset:
+                with open(path, "rb") as f:
+                    f.seek(offset*8)
+                    live = np.fromfile(f, dtype=np.int64, count=length - offset)
+            self.__windows[bucket] = SlidingWindow(live)
+        return self.__windows[bucket]
+
+    def __discard_uncommitted(self):
+        # Appends of a crashed process may have reached the segment files without being committed.
+        for bucket in self.buckets:
+            path = self.__segment_path(bucket)
+            if os.path.exists(path) and os.path.getsize(path) > self.__meta["lengths"][bucket]*8:
+                with open(path, "r+b") as f:
+                    f.truncate(self.__meta["lengths"][bucket]*8)
+
+    def __segment_path(self, bucket: str):
+        if bucket not in self.buckets:
+            raise KeyError(f"unknown bucket '{bucket}'")
+        return os.path.join(self.path, f"{bucket}.{self.__meta['generations'][bucket]}.i64")
+
+    def __read_meta(self):
+        path = os.path.join(self.path, META_FILE)
+        meta = {
+            "version": STORE_VERSION,
+            "offsets": {bucket: 0 for bucket in self.buckets},
+            "generations": {bucket: 0 for bucket in self.buckets},
+            "lengths": {bucket: 0 for bucket in self.buckets},
+            "metadata": {}
+        }
+        if os.path.exists(path):
+            with open(path) as f:
+                stored = json.load(f)
+            for key in ("offsets", "generations", "lengths"):
+                meta[key].update(stored.get(key, {}))
+            meta["metadata"] = stored.get("metadata", {})
+        return meta
+
+    def __write_meta(self):
+        path = os.path.join(self.path, META_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.__meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
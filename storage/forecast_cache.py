@@ -0,0 +1,57 @@
+__all__ = ("ForecastCache", )
+
+import collections
+import json
+import os
+
+
+class ForecastCache:
+    """Bounded LRU cache of daily forecasts, persisted as one json file.
+
+    Keys are tuples of json serializable values, e.g. (device, date, bucket, history version),
+    values are json serializable forecasts. Without autosave, put only marks the
+    cache dirty and the owner has to call save.
+    """
+
+    def __init__(self, path: str, max_entries: int = 4096, autosave: bool = True):
+        self.path = path
+        self.max_entries = max(1, max_entries)
+        self.autosave = autosave
+        self.dirty = False
+        self.__entries = collections.OrderedDict()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for key, value in json.load(f):
+                    self.__entries[self.__key(key)] = value
+
+    def get(self, key):
+        key = self.__key(key)
+        value = self.__entries.get(key)
+        if value is not None:
+            self.__entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        key = self.__key(key)
+        self.__entries[key] = value
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.max_entries:
+            self.__entries.popitem(last=False)
+        self.dirty = True
+        if self.autosave:
+            self.save()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump([[json.loads(key), value] for key, value in self.__entries.items()], f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    @staticmethod
+    def __key(key):
+        # Tuples and the lists they become in json have to end up as the same key.
+        return json.dumps(key)
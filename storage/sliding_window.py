@@ -0,0 +1,82 @@
+__all__ = ("SlidingWindow", )
+
+import numpy as np
+
+
+class SlidingWindow:
+    """Time ordered int64 values, appended at the tail and expired from the head.
+
+    Values live in one buffer between a head and a tail index. Expiring only moves
+    the head, the buffer is reallocated when it is full, at that point dead entries
+    are dropped and the capacity is doubled if still more than half of it is used,
+    so every operation is amortized O(1) besides the binary search of expire.
+    A published view is never written to, it stays valid after later changes.
+    """
+
+    def __init__(self, values=(), capacity: int = 64):
+        values = np.asarray(values, dtype=np.int64)
+        self.__buffer = np.empty(max(capacity, 2*len(values), 1), dtype=np.int64)
+        self.__buffer[:len(values)] = values
+        self.__head = 0
+        self.__tail = len(values)
+
+    def __len__(self):
+        return self.__tail - self.__head
+
+    def append(self, value: int):
+        if self.__tail == len(self.__buffer):
+            self.__reallocate(1)
+        self.__buffer[self.__tail] = value
+        self.__tail += 1
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=np.int64)
+        if self.__tail + len(values) > len(self.__buffer):
+            self.__reallocate(len(values))
+        self.__buffer[self.__tail:self.__tail + len(values)] = values
+        self.__tail += len(values)
+
+    def insert(self, values) -> int:
+        # Inserts values in time order and returns the index of the first one. Values that do not belong
+        # at the tail are merged into a new buffer, the published views still see the old one.
+        values = np.sort(np.asarray(values, dtype=np.int64))
+        live = self.view()
+        if len(values) == 0:
+            return len(live)
+        position = int(np.searchsorted(live, values[0], side="right"))
+        if position == len(live):
+            self.extend(values)
+            return position
+        merged = np.insert(live, np.searchsorted(live, values, side="right"), values)
+        self.__buffer = np.empty(max(len(self.__buffer), 2*len(merged)), dtype=np.int64)
+        self.__buffer[:len(merged)] = merged
+        self.__head = 0
+        self.__tail = len(merged)
+        return position
+
+    def expire(self, cutoff: int) -> np.ndarray:
+        # Drops all values older than cutoff and returns them.
+        return self.drop(int(np.searchsorted(self.view(), cutoff, side="left")))
+
+    def drop(self, n: int) -> np.ndarray:
+        # Drops the n oldest values and returns them.
+        n = max(0, min(n, len(self)))
+        dropped = self.__buffer[self.__head:self.__head + n].copy()
+        self.__head += n
+        return dropped
+
+    def view(self) -> np.ndarray:
+        view = self.__buffer[self.__head:self.__tail]
+        view.flags.writeable = False
+        return view
+
+    def __reallocate(self, additional: int):
+        live = len(self)
+        capacity = len(self.__buffer)
+        while live + additional > capacity//2:
+            capacity *= 2
+        buffer = np.empty(capacity, dtype=np.int64)
+        buffer[:live] = self.__buffer[self.__head:self.__tail]
+        self.__buffer = buffer
+        self.__head = 0
+        self.__tail = live
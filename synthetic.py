@@ -0,0 +1,120 @@
+"""
+   Copyright 2022 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   Synthetic window contact data for the tests, the benchmarks and produce_test_data.py, and an operator to
+   feed it to offline
+"""
+
+import numpy as np
+import pandas as pd
+
+SECONDS_PER_DAY = 24*3600
+
+
+def generate_window_events(devices=1, days=60, events_per_day=4, start="2024-01-01", seed=0):
+    # Returns (device_id, utc timestamp, window_open) records sorted by time. Every device opens its
+    # window around events_per_day habitual times of day and closes it again 5 to 30 minutes later.
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(start).value // 10**9
+    records = []
+    for d in range(devices):
+        device_id = f"device:{d}"
+        habits = np.sort(rng.integers(0, SECONDS_PER_DAY - 3600, events_per_day))
+        day_starts = start + np.arange(days)*SECONDS_PER_DAY
+        openings = (day_starts[:, np.newaxis] + habits[np.newaxis, :] + rng.normal(0, 600, (days, events_per_day)).astype(np.int64)).ravel()
+        closings = openings + rng.integers(5*60, 30*60, len(openings))
+        seconds = np.concatenate((openings, closings))
+        window_open = np.concatenate((np.ones(len(openings), dtype=bool), np.zeros(len(closings), dtype=bool)))
+        records.extend(zip([device_id]*len(seconds), seconds.tolist(), window_open.tolist()))
+    records.sort(key=lambda record: record[1])
+    return [(device_id, pd.Timestamp(seconds, unit="s"), window_open) for device_id, seconds, window_open in records]
+
+
+def generate_opening_history(n, days=60, clusters=4, end="2024-03-01", seed=0):
+    # n sorted opening times in epoch seconds, spread over the days before end around a few times of day
+    rng = np.random.default_rng(seed)
+    end = pd.Timestamp(end).value // 10**9
+    habits = rng.integers(0, SECONDS_PER_DAY, clusters)
+    day_starts = end - rng.integers(1, days + 1, n)*SECONDS_PER_DAY
+    day_starts -= day_starts % SECONDS_PER_DAY
+    seconds = day_starts + rng.choice(habits, n) + rng.normal(0, 900, n).astype(np.int64)
+    return np.sort(seconds)
+
+
+def generate_room_events(rooms=10, days=28, start="2024-01-01", seed=0, habits_per_day=3, skip_probability=0.1, noise_per_day=0.5,
+                         weekend_shift=5400, report_interval=300, heartbeat_interval=1800, bounce_probability=0.05):
+    # Returns (device_id, utc timestamp, window_open) records sorted by time, like generate_window_events, of rooms
+    # whose contact sensors behave like real ones:
+    # - the window is opened around habits_per_day times of day, each skipped with skip_probability, and
+    #   additionally at noise_per_day random times on average,
+    # - on weekends the habits are shifted by up to weekend_shift seconds per room,
+    # - an open window is reported again every report_interval seconds, a closed one every heartbeat_interval
+    #   seconds (0 disables either), and with bounce_probability the contact bounces when the window closes.
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(start).value // 10**9
+    day_starts = start + np.arange(days)*SECONDS_PER_DAY
+    weekend = (day_starts // SECONDS_PER_DAY + 3) % 7 >= 5
+    device_ids, seconds, window_open = [], [], []
+    for r in range(rooms):
+        habits = np.sort(rng.integers(3600, SECONDS_PER_DAY - 3*3600, habits_per_day))
+        weekend_habits = habits + rng.integers(-weekend_shift, weekend_shift + 1, habits_per_day)
+        openings = (day_starts[:, np.newaxis] + np.where(weekend[:, np.newaxis], weekend_habits, habits) + rng.normal(0, 600, (days, habits_per_day)).astype(np.int64))
+        openings = openings[rng.random(openings.shape) >= skip_probability]
+        noise = np.repeat(day_starts, rng.poisson(noise_per_day, days))
+        openings = np.sort(np.concatenate((openings, noise + rng.integers(0, SECONDS_PER_DAY, len(noise)))))
+        closings = openings + rng.integers(3*60, 30*60, len(openings))
+        # The window cannot be opened again while it is still open.
+        keep = np.concatenate(([True], openings[1:] > np.maximum.accumulate(closings)[:-1]))
+        openings, closings = openings[keep], closings[keep]
+
+        room_seconds = [openings, closings]
+        room_window_open = [np.ones(len(openings), dtype=bool), np.zeros(len(closings), dtype=bool)]
+        if report_interval:
+            durations = closings - openings
+            n_reports = (durations - 1)//report_interval
+            reports = np.repeat(openings, n_reports) + report_interval*(np.arange(n_reports.sum()) - np.repeat(np.cumsum(n_reports) - n_reports, n_reports) + 1)
+            room_seconds.append(reports)
+            room_window_open.append(np.ones(len(reports), dtype=bool))
+        bounces = closings[rng.random(len(closings)) < bounce_probability]
+        gaps = rng.integers(1, 5, len(bounces))
+        room_seconds += [bounces + gaps, bounces + 2*gaps]
+        room_window_open += [np.ones(len(bounces), dtype=bool), np.zeros(len(bounces), dtype=bool)]
+        if heartbeat_interval:
+            heartbeats = np.arange(start + int(rng.integers(0, heartbeat_interval)), start + days*SECONDS_PER_DAY, heartbeat_interval)
+            episode = np.searchsorted(openings, heartbeats, side="right") - 1
+            closed = (episode < 0) | (heartbeats > closings[np.maximum(episode, 0)] + 10)
+            room_seconds.append(heartbeats[closed])
+            room_window_open.append(np.zeros(closed.sum(), dtype=bool))
+
+        room_seconds = np.concatenate(room_seconds)
+        device_ids.append(np.full(len(room_seconds), r))
+        seconds.append(room_seconds)
+        window_open.append(np.concatenate(room_window_open))
+    device_ids, seconds, window_open = np.concatenate(device_ids), np.concatenate(seconds), np.concatenate(window_open)
+    order = np.lexsort((device_ids, seconds))
+    timestamps = pd.to_datetime(seconds[order], unit="s")
+    return [(f"room:{r}", timestamp, bool(open_)) for r, timestamp, open_ in zip(device_ids[order], timestamps, window_open[order])]
+
+
+def create_operator(data_path, produce=None, **config):
+    # An operator with its state in data_path and a one day init phase, not connected to kafka. window_open of
+    # the messages is True for an open window. produce replaces OperatorBase.produce, also while replaying.
+    from main import Operator, CustomConfig
+    operator = Operator()
+    operator.config = CustomConfig({"data_path": data_path, "init_phase_length": 1, "init_phase_level": "d", "contact_sensor": False, **config})
+    if produce is not None:
+        operator.produce = produce
+    operator.setup_state()
+    return operator
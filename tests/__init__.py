@@ -15,3 +15,9 @@
 """
 
 from .test_operator import *
+from .test_algo import *
+from .test_storage import *
+from .test_benchmark import *
+from .test_runtime import *
+from .test_startup import *
+from .test_load import *
@@ -0,0 +1,163 @@
+"""
+   Copyright 2022 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   Benchmarks of the operator hot paths. Run from the repository root:
+
+       python tests/benchmark.py                     # print report
+       python tests/benchmark.py --update-baseline   # store results as new baseline
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import algo
+from synthetic import generate_window_events, generate_opening_history, create_operator
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources", "benchmark_baseline.json")
+HISTORY_SIZES = (250, 1000, 4000)
+
+# A result regresses if its p50 latency or peak memory exceeds the baseline by these factors.
+LATENCY_TOLERANCE = 2.0
+MEMORY_TOLERANCE = 1.5
+
+
+def measure(func, repeat):
+    func()  # warm up caches and lazy imports
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return summarize(latencies, peak)
+
+
+def summarize(latencies, peak_memory):
+    latencies = np.asarray(latencies)
+    return {
+        "throughput": float(len(latencies)/latencies.sum()),
+        "p50_ms": float(np.percentile(latencies, 50)*1000),
+        "p99_ms": float(np.percentile(latencies, 99)*1000),
+        "peak_memory_kb": float(peak_memory/1024)
+    }
+
+
+def algo_benchmarks(history_sizes=HISTORY_SIZES, repeat=20):
+    results = {}
+    for n in history_sizes:
+        history = generate_opening_history(n)
+        current_timestamp = pd.Timestamp(int(history[-1]) + 24*3600, unit="s").floor("d")
+        clustering = algo.IncrementalClustering.fit(history % algo.SECONDS_PER_DAY)
+        boundaries, indices = algo.compute_clusters_boundaries(history, clustering=clustering)
+        largest_cluster = history[max(indices.values(), key=len)]
+
+        results[f"compute_clusters_boundaries[{n}]"] = measure(lambda: algo.compute_clusters_boundaries(history), repeat)
+        results[f"compute_clusters_boundaries_incremental[{n}]"] = measure(lambda: algo.compute_clusters_boundaries(history, clustering=clustering), repeat)
+        results[f"compute_confidence_from_spreading[{n}]"] = measure(lambda: algo.compute_confidence_from_spreading(largest_cluster, 600, 3600), repeat)
+        results[f"check_for_times_during_last_x_days[{n}]"] = measure(lambda: algo.check_for_times_during_last_x_days_batch(current_timestamp, history, list(boundaries.values())), repeat)
+        results[f"compute_day_forecast[{n}]"] = measure(lambda: algo.compute_day_forecast(current_timestamp, history, 600, 3600, clustering=clustering), repeat)
+    return results
+
+
+def operator_benchmarks(days=(15, 60), events_per_day=8, repeat=20):
+    try:
+        # Needs operator_lib, create_operator imports it as well
+        import main
+    except ImportError as ex:
+        print(f"Skipping operator benchmarks: {ex}", file=sys.stderr)
+        return {}
+    results = {}
+    for n_days in days:
+        records = generate_window_events(days=n_days, events_per_day=events_per_day)
+        with tempfile.TemporaryDirectory() as data_path:
+            operator = create_operator(data_path)
+            latencies = []
+            tracemalloc.start()
+            for device_id, timestamp, window_open in records:
+                start = time.perf_counter()
+                operator.run({"window_open": window_open}, None, device_id, timestamp.to_pydatetime())
+                latencies.append(time.perf_counter() - start)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[f"Operator.run[{n_days}d]"] = summarize(latencies, peak)
+
+            device = operator.devices.get(records[0][0])
+            # measure calls compute_forecast repeat + 2 times, each for a day not computed before, so none is a cache hit.
+            timestamps = iter(pd.date_range(pd.Timestamp(records[-1][1]).ceil("d"), periods=repeat + 2, freq="D"))
+            def compute_forecast():
+                timestamp = next(timestamps)
+                operator.compute_forecast(device, timestamp, operator.check_if_weekend(timestamp))
+            results[f"Operator.compute_forecast[{n_days}d]"] = measure(compute_forecast, repeat)
+            operator.close_state()
+    return results
+
+
+def run_benchmarks():
+    results = algo_benchmarks()
+    results.update(operator_benchmarks())
+    return results
+
+
+def load_baseline():
+    if not os.path.exists(BASELINE_FILE):
+        return {}
+    with open(BASELINE_FILE) as file:
+        return json.load(file)
+
+
+def find_regressions(results, baseline):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        if result["p50_ms"] > baseline[name]["p50_ms"]*LATENCY_TOLERANCE:
+            regressions.append(f"{name}: p50 {result['p50_ms']:.3f} ms, baseline {baseline[name]['p50_ms']:.3f} ms")
+        if result["peak_memory_kb"] > baseline[name]["peak_memory_kb"]*MEMORY_TOLERANCE:
+            regressions.append(f"{name}: peak memory {result['peak_memory_kb']:.0f} kB, baseline {baseline[name]['peak_memory_kb']:.0f} kB")
+    return regressions
+
+
+def print_report(results, file=sys.stdout):
+    print(f"{'benchmark':<55} {'ops/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'peak kB':>9}", file=file)
+    for name, result in results.items():
+        print(f"{name:<55} {result['throughput']:>10.1f} {result['p50_ms']:>9.3f} {result['p99_ms']:>9.3f} {result['peak_memory_kb']:>9.0f}", file=file)
+
+
+if __name__ == "__main__":
+    results = run_benchmarks()
+    print_report(results)
+    if "--update-baseline" in sys.argv:
+        baseline = load_baseline()
+        baseline.update(results)
+        with open(BASELINE_FILE, "w") as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+    else:
+        regressions = find_regressions(results, load_baseline())
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
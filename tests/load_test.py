@@ -0,0 +1,192 @@
+"""
+   Copyright 2022 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+   End-to-end load test of the operator with synthetic rooms and an in-process
+   stand-in for kafka, for capacity planning without a broker. Run from the
+   repository root:
+
+       python tests/load_test.py --rooms 100 --days 28 --rate 5000
+       python tests/load_test.py --rooms 100 --config batch_messages=64 --config forecast_workers=2
+"""
+
+import argparse
+import json
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+if not __package__:
+    # Run as a script, also when re-imported by the processes of forecast_workers
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import generate_room_events, create_operator
+
+# Number of consumed messages between two measurements of the state size
+STATE_SAMPLE_INTERVAL = 10000
+
+
+class LocalTopic:
+    # A topic of an in-process broker. Messages are json strings like on kafka, stamped with the time they were produced.
+    def __init__(self, max_size: int = 0):
+        self.__queue = queue.Queue(max_size)
+        self.produced = 0
+
+    def produce(self, key, value: str):
+        self.__queue.put((key, value, time.perf_counter()))
+        self.produced += 1
+
+    def poll(self, timeout: float = 1.0):
+        try:
+            return self.__queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class LocalProducer:
+    # Produces records to a topic at rate messages per second, as fast as possible if rate is 0.
+    def __init__(self, topic: LocalTopic, records, rate: float = 0):
+        self.topic = topic
+        self.records = records
+        self.rate = rate
+        self.__thread = None
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, name="load-producer", daemon=True)
+        self.__thread.start()
+
+    def join(self):
+        self.__thread.join()
+
+    def __run(self):
+        start = time.perf_counter()
+        for i, (device_id, timestamp, window_open) in enumerate(self.records):
+            if self.rate:
+                delay = start + i/self.rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            self.topic.produce(device_id, json.dumps({"device_id": device_id, "window_open": window_open, "time": timestamp.isoformat()}))
+
+
+def directory_size(path):
+    size = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def run_load_test(records, rate: float = 0, data_path: str = None, **config):
+    # Feeds records through a local topic into Operator.run, its outputs into another topic. The latency of a
+    # message is the time from being produced until run returned, at rate 0 it is mostly the time spent waiting
+    # in the topic. Messages applied later (batch_messages) or forecasts computed elsewhere (forecast_workers)
+    # are covered by the throughput, which includes draining them.
+    import pandas as pd
+
+    with tempfile.TemporaryDirectory() as tmp_path:
+        data_path = data_path or tmp_path
+        input_topic, output_topic = LocalTopic(max_size=100000), LocalTopic()
+        operator = create_operator(data_path, produce=lambda output: output_topic.produce(None, json.dumps(output)), **config)
+
+        first_seq = operator.wal.last_seq
+        producer = LocalProducer(input_topic, records, rate)
+        latencies = np.empty(len(records))
+        state_samples = []
+        start = time.perf_counter()
+        producer.start()
+        for i in range(len(records)):
+            message = input_topic.poll(timeout=10)
+            if message is None:
+                raise RuntimeError(f"no message after {i} of {len(records)}")
+            _, value, produced = message
+            value = json.loads(value)
+            output = operator.run({"window_open": value["window_open"]}, None, value["device_id"], pd.Timestamp(value["time"]).to_pydatetime())
+            if output:
+                operator.produce(output)
+            latencies[i] = time.perf_counter() - produced
+            if (i + 1) % STATE_SAMPLE_INTERVAL == 0:
+                state_samples.append((i + 1, directory_size(data_path)))
+        producer.join()
+        # Messages the operator logged, and the ones left in the topic
+        consumed = operator.wal.last_seq - first_seq
+        unconsumed = 0
+        while input_topic.poll(timeout=0) is not None:
+            unconsumed += 1
+        operator.close_state()
+        seconds = time.perf_counter() - start
+        state_bytes = directory_size(data_path)
+
+    rooms = len({device_id for device_id, _, _ in records})
+    simulated_days = (records[-1][1] - records[0][1]).total_seconds()/(24*3600) if records else 0
+    return {
+        "messages": len(records),
+        "consumed": consumed,
+        "unconsumed": unconsumed,
+        "rooms": rooms,
+        "simulated_days": simulated_days,
+        "seconds": seconds,
+        "messages_per_second": len(records)/seconds,
+        "latency_p50_ms": float(np.percentile(latencies, 50)*1000) if len(records) else 0.0,
+        "latency_p99_ms": float(np.percentile(latencies, 99)*1000) if len(records) else 0.0,
+        "latency_max_ms": float(latencies.max()*1000) if len(records) else 0.0,
+        "outputs": output_topic.produced,
+        "state_bytes": state_bytes,
+        "state_bytes_per_room_and_day": state_bytes/max(rooms, 1)/max(simulated_days, 1),
+        "state_samples": state_samples + [(len(records), state_bytes)]
+    }
+
+
+def print_report(result, file=sys.stdout):
+    print(f"{result['messages']} messages of {result['rooms']} rooms over {result['simulated_days']:.1f} days in {result['seconds']:.1f} s", file=file)
+    print(f"sustained      {result['messages_per_second']:>10.0f} messages/s", file=file)
+    print(f"latency p50    {result['latency_p50_ms']:>10.3f} ms", file=file)
+    print(f"latency p99    {result['latency_p99_ms']:>10.3f} ms", file=file)
+    print(f"latency max    {result['latency_max_ms']:>10.3f} ms", file=file)
+    print(f"consumed       {result['consumed']:>10}, {result['unconsumed']} left over", file=file)
+    print(f"outputs        {result['outputs']:>10}", file=file)
+    print(f"state          {result['state_bytes']/1024:>10.0f} kB, {result['state_bytes_per_room_and_day']:.0f} bytes per room and day", file=file)
+    for messages, size in result["state_samples"]:
+        print(f"  after {messages:>9} messages {size/1024:>10.0f} kB", file=file)
+
+
+def parse_config(values):
+    config = {}
+    for value in values:
+        key, _, value = value.partition("=")
+        config[key] = value
+    return config
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of the operator with synthetic rooms")
+    parser.add_argument("--rooms", type=int, default=50)
+    parser.add_argument("--days", type=int, default=28)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rate", type=float, default=0, help="messages per second, 0 produces as fast as possible")
+    parser.add_argument("--report-interval", type=int, default=300, help="seconds between reports of an open window")
+    parser.add_argument("--heartbeat-interval", type=int, default=1800, help="seconds between reports of a closed window")
+    parser.add_argument("--data-path", default=None, help="keep the state here instead of a temporary directory")
+    parser.add_argument("--config", action="append", default=[], help="operator config as key=value, repeatable")
+    args = parser.parse_args()
+
+    records = generate_room_events(rooms=args.rooms, days=args.days, seed=args.seed, report_interval=args.report_interval, heartbeat_interval=args.heartbeat_interval)
+    print_report(run_load_test(records, rate=args.rate, data_path=args.data_path, **parse_config(args.config)))
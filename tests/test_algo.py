@@ -0,0 +1,129 @@
+"""
+   Copyright 2022 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import algo
+import numpy as np
+import pandas as pd
+import unittest
+
+
+def random_timestamps(seed, n, days=60):
+    rng = np.random.default_rng(seed)
+    ns = pd.Timestamp("2024-01-01").value + rng.integers(0, days*24*3600*10**9, n)
+    # Ties for rounding to full seconds
+    ns[:5] = ns[:5] // 10**9 * 10**9 + 5*10**8
+    return list(pd.to_datetime(ns))
+
+
+class TestFeatureExtraction(unittest.TestCase):
+    def test_arrays_match_scalar_functions(self):
+        for seed in range(10):
+            timestamps = random_timestamps(seed, 200)
+            np.testing.assert_array_equal(algo.convert_to_day_seconds_array(timestamps), [algo.convert_to_day_seconds(ts) for ts in timestamps])
+            np.testing.assert_array_equal(algo.compute_frac_of_day_array(timestamps), [algo.compute_frac_of_day(ts) for ts in timestamps])
+            np.testing.assert_array_equal(algo.project_to_unit_circle_array(timestamps), [algo.project_to_unit_circle(ts) for ts in timestamps])
+
+    def test_input_types(self):
+        timestamps = random_timestamps(0, 50)
+        boundaries, indices = algo.compute_clusters_boundaries(timestamps)
+        as_datetime64 = pd.DatetimeIndex(timestamps).values
+        self.assertEqual(algo.compute_clusters_boundaries(as_datetime64)[0], boundaries)
+
+        seconds = np.array([ts.value // 10**9 for ts in timestamps], dtype=np.int64)
+        np.testing.assert_array_equal(algo.convert_to_day_seconds_array(seconds), seconds % (24*3600))
+
+
+class TestDailyAppearance(unittest.TestCase):
+    def test_days_with_openings(self):
+        # Openings at 07:00 on five weekdays and at 07:30 on a saturday
+        timestamps = [pd.Timestamp(f"2024-01-{day:02d} 07:00") for day in (1, 2, 3, 4, 5)] + [pd.Timestamp("2024-01-06 07:30")]
+        current_timestamp = pd.Timestamp("2024-01-09 00:00:05")  # Tuesday
+        boundaries = [(pd.Timestamp("07:00").time(), pd.Timestamp("07:10").time()), (pd.Timestamp("07:20").time(), pd.Timestamp("07:40").time())]
+
+        days = algo.check_for_times_during_last_x_days_batch(current_timestamp, timestamps, boundaries, confidence_days=7)
+        np.testing.assert_array_equal(days, [5, 0])
+        days = algo.check_for_times_during_last_x_days_batch(current_timestamp, timestamps[::-1], boundaries, confidence_days=3)
+        np.testing.assert_array_equal(days, [2, 0])
+        self.assertEqual(algo.compute_confidence_by_daily_apperance(current_timestamp, timestamps, boundaries[0], confidence_days=10), .5)
+
+
+class TestDayForecast(unittest.TestCase):
+    def test_cluster_around_midnight(self):
+        # Openings around midnight after the weekdays of 2024-01-15 to 2024-01-19, the one at 00:01:33 belongs to the 18th.
+        timestamps = [pd.Timestamp(ts) for ts in ("2024-01-15 23:56", "2024-01-16 23:58", "2024-01-17 23:57:30", "2024-01-19 00:01:33", "2024-01-19 23:59")]
+        current_timestamp = pd.Timestamp("2024-01-22 00:00:05")  # Monday
+        seconds = np.array([ts.value // 10**9 for ts in timestamps])
+        for clustering in (None, algo.IncrementalClustering.fit(seconds % 86400)):
+            forecast = algo.compute_day_forecast(current_timestamp, timestamps, 600, 3600, confidence_days=7, clustering=clustering)
+            self.assertEqual(len(forecast), 1)
+            pair_of_boundaries, confidence_by_spreading, confidence_by_daily_appearance, overall_confidence = forecast[0]
+            self.assertEqual(pair_of_boundaries, (pd.Timestamp("23:56").time(), pd.Timestamp("00:01:33").time()))
+            self.assertEqual(confidence_by_daily_appearance, 5/7)
+            self.assertEqual(confidence_by_spreading, 1)
+            self.assertEqual(overall_confidence, 5/7)
+
+
+class TestIncrementalClustering(unittest.TestCase):
+    def test_matches_dbscan(self):
+        try:
+            from sklearn.cluster import DBSCAN
+        except ImportError as ex:
+            self.skipTest(ex)
+        rng = np.random.default_rng(0)
+        for i in range(50):
+            # Openings around midnight and spread over the day
+            day_seconds = np.concatenate((rng.normal(0, 1800, 30).astype(int) % (24*3600), rng.integers(0, 24*3600, 30)))
+            projections = algo.project_to_unit_circle_array(day_seconds)
+            expected = DBSCAN(eps=algo.EPSILON, min_samples=2).fit(projections).labels_
+            np.testing.assert_array_equal(algo.IncrementalClustering.fit(day_seconds).labels(day_seconds), expected)
+
+    def test_add_remove(self):
+        clustering = algo.IncrementalClustering.fit([100, 200, 5000])
+        self.assertEqual(clustering.segments(), [(100, 200)])
+        clustering.add([5100, 86300])
+        self.assertEqual(clustering.segments(), [(86300, 200), (5000, 5100)])
+        np.testing.assert_array_equal(clustering.labels([5000, 100, 200, 86300, 5100]), [0, 1, 1, 1, 0])
+        clustering.remove([5000])
+        np.testing.assert_array_equal(clustering.labels([100, 5100]), [0, -1])
+        clustering.remove([100, 200, 86300, 5100])
+        self.assertEqual((len(clustering), clustering.segments(), len(clustering.histogram.seconds)), (0, [], 0))
+
+
+class TestCircularStatistics(unittest.TestCase):
+    def test_cluster_around_midnight(self):
+        # 23:55, 00:05 and 23:56:40 on consecutive days
+        timestamps = np.array([19000*86400 + 86100, 19001*86400 + 300, 19002*86400 + 86200])
+        self.assertLess(algo.compute_second_momentum(timestamps), 300)
+        clustering = algo.IncrementalClustering.fit(timestamps % 86400)
+        self.assertEqual(clustering.segments(), [(86100, 300)])
+        self.assertAlmostEqual(clustering.spread(300), algo.compute_second_momentum(timestamps))
+
+    def test_histogram_matches_timestamps(self):
+        rng = np.random.default_rng(0)
+        for center in (600, 43200, 86000):
+            seconds = 19000*86400 + (center + rng.normal(0, 600, 50).astype(int)) % 86400
+            histogram = algo.CircularHistogram()
+            histogram.add(seconds % 86400)
+            histogram.add([1000, 2000])
+            histogram.remove([1000, 2000])
+            self.assertEqual(len(histogram), 50)
+            first, last = algo.IncrementalClustering.fit(seconds % 86400).segments()[0]
+            # Equal up to rounding, the sums run over the seconds in a different order.
+            self.assertAlmostEqual(histogram.spread(first, last), algo.compute_second_momentum(seconds))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+"""
+   Copyright 2022 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from . import benchmark
+import os
+import unittest
+
+
+@unittest.skipUnless(os.environ.get("BENCHMARK"), "set BENCHMARK=1 to run the benchmarks")
+class TestBenchmark(unittest.TestCase):
+    def test_no_regressions(self):
+        results = benchmark.run_benchmarks()
+        benchmark.print_report(results)
+        regressions = benchmark.find_regressions(results, benchmark.load_baseline())
+        self.assertEqual(regressions, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+"""
+   Copyright 2022 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from . import load_test
+from .test_operator import create_operator, stream
+from synthetic import generate_room_events
+import os
+import tempfile
+import unittest
+
+
+class TestSyntheticRooms(unittest.TestCase):
+    def test_seeded_and_consistent(self):
+        records = generate_room_events(rooms=3, days=7, seed=1)
+        self.assertEqual(records, generate_room_events(rooms=3, days=7, seed=1))
+        self.assertNotEqual(records, generate_room_events(rooms=3, days=7, seed=2))
+        self.assertEqual([timestamp for _, timestamp, _ in records], sorted(timestamp for _, timestamp, _ in records))
+        self.assertEqual({device_id for device_id, _, _ in records}, {"room:0", "room:1", "room:2"})
+
+        quiet = generate_room_events(rooms=3, days=7, seed=1, report_interval=0, heartbeat_interval=0, bounce_probability=0)
+        # Without repeated reports every message changes the window state.
+        for room in ("room:0", "room:1", "room:2"):
+            states = [window_open for device_id, _, window_open in quiet if device_id == room]
+            self.assertTrue(all(a != b for a, b in zip(states, states[1:])))
+        self.assertGreater(len(records), 3*len(quiet))
+
+
+@unittest.skipUnless(os.environ.get("LOAD_TEST"), "set LOAD_TEST=1 to run the load test")
+class TestLoad(unittest.TestCase):
+    def test_all_messages_consumed(self):
+        records = generate_room_events(rooms=5, days=10)
+        with tempfile.TemporaryDirectory() as data_path:
+            operator = create_operator(data_path)
+            expected = len(stream(operator, records))
+            operator.close_state()
+        for config in ({}, {"batch_messages": 64}):
+            result = load_test.run_load_test(records, **config)
+            load_test.print_report(result)
+            self.assertEqual((result["consumed"], result["unconsumed"]), (len(records), 0))
+            self.assertEqual(result["outputs"], expected)
+            self.assertGreater(result["state_bytes"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
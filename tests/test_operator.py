@@ -14,11 +14,91 @@
    limitations under the License.
 """
 
-from ._util import *
+try:
+    from ._util import *
+except ModuleNotFoundError:
+    # The mocks need util and mf_lib
+    MockOperator = None
+from synthetic import generate_room_events
+import synthetic
+from storage import WriteAheadLog
+from runtime import utc_to_local
 import algo
+import json
+import numpy as np
+import os
+import signal
+import subprocess
+import sys
+import pandas as pd
+import tempfile
 import unittest
 
+try:
+    from main import Operator
+except ModuleNotFoundError as ex:
+    # main needs operator_lib
+    Operator = None
+    operator_import_error = ex
 
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Streams the first messages of crash_records in a fresh interpreter, prints the outputs and exits without closing the state.
+CRASH = (
+    "import json, os, sys\n"
+    "from tests.test_operator import create_operator, stream, crash_records\n"
+    "operator = create_operator(sys.argv[1], **json.loads(sys.argv[3]))\n"
+    "print(json.dumps(stream(operator, crash_records()[:int(sys.argv[2])])), flush=True)\n"
+    "os._exit(1)\n"
+)
+
+# Streams crash_records up to the first index with forecast workers and waits for the forecasts, streams them up to the
+# second index and exits right after a checkpoint, before the forecasts of those messages are delivered.
+PENDING_CRASH = (
+    "import json, os, sys, time\n"
+    "from tests.test_operator import create_operator, stream, crash_records\n"
+    "operator = create_operator(sys.argv[1], forecast_workers=1)\n"
+    "records = crash_records()\n"
+    "stream(operator, records[:int(sys.argv[2])])\n"
+    "while operator.scheduler.pending:\n"
+    "    time.sleep(0.01)\n"
+    "with operator.lock:\n"
+    "    stream(operator, records[int(sys.argv[2]):int(sys.argv[3])])\n"
+    "    operator.checkpoint()\n"
+    "    print(json.dumps(operator.produced), flush=True)\n"
+    "    os._exit(1)\n"
+)
+
+
+def crash_records():
+    return generate_room_events(rooms=2, days=10, seed=4)
+
+
+def delay(records, max_delay, seed=0):
+    # The records in the order they arrive if each is delayed by up to max_delay seconds
+    delays = np.random.default_rng(seed).integers(0, max_delay, len(records))
+    return [records[i] for i in np.argsort([timestamp.value // 10**9 + delay for (_, timestamp, _), delay in zip(records, delays)], kind="stable")]
+
+
+def create_operator(data_path, **config):
+    # An operator with its state in data_path, collecting everything it produces in operator.produced
+    produced = []
+    operator = synthetic.create_operator(data_path, produce=produced.append, **config)
+    operator.produced = produced
+    return operator
+
+
+def stream(operator, records):
+    # Feeds (device_id, timestamp, window_open) records through run, collects its outputs with the produced ones.
+    for device_id, timestamp, window_open in records:
+        output = operator.run({"window_open": window_open}, None, device_id, timestamp.to_pydatetime())
+        if output:
+            operator.produce(output)
+    return operator.produced
+
+
+@unittest.skipIf(MockOperator is None, "util and mf_lib are not installed")
 class TestOperator(unittest.TestCase):
     def test_route(self):
         mock_kafka_consumer = MockKafkaConsumer(mock_messages)
@@ -56,5 +136,313 @@ class TestOperator(unittest.TestCase):
             self.skipTest(ex)
 
 
+class TestOperatorState(unittest.TestCase):
+    def setUp(self):
+        if Operator is None:
+            self.skipTest(operator_import_error)
+        self.data_path = tempfile.TemporaryDirectory()
+        self.addCleanup(self.data_path.cleanup)
+
+    def create_operator(self, name, **config):
+        return create_operator(os.path.join(self.data_path.name, name), **config)
+
+    def test_run_batch_matches_run(self):
+        # Two weeks around each daylight saving time transition of 2024
+        records = generate_room_events(rooms=1, days=14, start="2024-03-24", seed=1) + generate_room_events(rooms=1, days=14, start="2024-10-20", seed=2)
+        operator = self.create_operator("stream")
+        expected = stream(operator, records)
+        operator.close_state()
+
+        operator = self.create_operator("batch")
+        outputs = operator.run_batch("room:0", [(timestamp, window_open) for _, timestamp, window_open in records])
+        operator.close_state()
+        self.assertGreater(len(expected), 20)
+        self.assertEqual(outputs, expected)
+
+    def test_batched_messages_match_per_message(self):
+        records = generate_room_events(rooms=3, days=30, seed=5)
+        # Arriving up to half an hour late, put back in order by the reorder buffer
+        for reorder_window, records in ((0, records), (3600, delay(records, 1800))):
+            operator = self.create_operator(f"per_message_{reorder_window}", reorder_window=reorder_window)
+            expected = stream(operator, records)
+            operator.close_state()
+            operator = self.create_operator(f"batched_{reorder_window}", reorder_window=reorder_window, batch_messages=64, batch_interval=3600)
+            stream(operator, records)
+            operator.close_state()
+            self.assertGreater(len(expected), 50)
+            self.assertEqual(operator.produced, expected)
+
+    def test_late_messages(self):
+        records = generate_room_events(rooms=1, days=30, seed=6)
+        operator = self.create_operator("ordered")
+        expected = stream(operator, records)
+        operator.close_state()
+
+        operator = self.create_operator("late")
+        last_timestamps = []
+        for record in delay(records, 1800):
+            stream(operator, [record])
+            last_timestamps.append(operator.devices.get("room:0").last_timestamp)
+        with operator.lock:
+            histories = operator.devices.get("room:0").histories()
+        operator.close_state()
+        # The day cursor never goes back, so the days of the forecasts do not either, and there is one forecast per day
+        # plus the ones recomputed for late window openings.
+        self.assertEqual(last_timestamps, sorted(last_timestamps))
+        forecast_days = [output[0]["timestamp"] for output in operator.produced if output[0]["overall_confidence"] is not None]
+        self.assertEqual(forecast_days, sorted(forecast_days))
+        self.assertEqual(sorted(set(forecast_days)), sorted({output[0]["timestamp"] for output in expected if output[0]["overall_confidence"] is not None}))
+        for history in histories.values():
+            self.assertTrue((np.diff(history) >= 0).all())
+
+    def test_redelivered_messages(self):
+        records = generate_room_events(rooms=1, days=20, seed=6)
+        # Up to the last window opening, then its last two days once more
+        records = records[:max(i for i, (_, _, window_open) in enumerate(records) if window_open) + 1]
+        redelivered = [record for record in records if record[1] >= records[-1][1] - pd.Timedelta(days=2)]
+        for i, config in enumerate(({}, {"batch_messages": 64, "batch_interval": 3600})):
+            operator = self.create_operator(f"redelivered_{i}", **config)
+            stream(operator, records)
+            with operator.lock:
+                operator.apply_batch()
+                histories = operator.devices.get("room:0").histories()
+            outputs = list(operator.produced)
+            stream(operator, redelivered)
+            with operator.lock:
+                operator.apply_batch()
+                for bucket, history in operator.devices.get("room:0").histories().items():
+                    np.testing.assert_array_equal(history, histories[bucket])
+            operator.close_state()
+            self.assertGreater(len(outputs), 15)
+            self.assertEqual(operator.produced, outputs)
+        self.assertGreater(len(redelivered), 100)
+
+    def test_opening_event_modes(self):
+        records = generate_room_events(rooms=1, days=20, seed=10)
+        # Local epoch seconds of the messages opening the window and of the ones closing it again
+        seconds = [utc_to_local(timestamp.value) // 10**9 for _, timestamp, _ in records]
+        window_open = [window_open for _, _, window_open in records]
+        openings = [seconds[i] for i in range(len(records)) if window_open[i] and (i == 0 or not window_open[i - 1])]
+        closings = {start: next((seconds[j] for j in range(i + 1, len(records)) if not window_open[j]), None)
+                    for i, start in enumerate(seconds) if start in openings}
+        # Ends in the middle of an opening
+        cut = max(i for i in range(len(records) // 2) if window_open[i])
+        for mode in ("transitions", "episodes"):
+            config = {"opening_event_mode": mode, "retention_days": 7}
+            operator = self.create_operator(f"per_message_{mode}", **config)
+            expected = stream(operator, records)
+            operator.close_state()
+            states = self.device_states(f"per_message_{mode}", **config)
+            self.assertGreater(len(expected), 15)
+            histories = states["room:0"][1]
+            recorded = sorted(histories["weekday"] + histories["weekend"])
+            self.assertEqual(recorded, [opening for opening in openings if opening >= openings[-1] - 7*86400])
+            for bucket in ("weekday", "weekend"):
+                durations = histories[f"{bucket}_duration"]
+                if mode == "transitions":
+                    self.assertEqual(durations, [])
+                    continue
+                # Expired together with their starts, the one of the last opening is missing while it is open
+                self.assertIn(len(histories[bucket]) - len(durations), (0, 1))
+                self.assertGreater(len(durations), 0)
+                self.assertEqual(durations, [closings[start] - start for start in histories[bucket][:len(durations)]])
+
+            operator = self.create_operator(f"restarted_{mode}", **config)
+            outputs = stream(operator, records[:cut + 1])
+            device = operator.devices.get("room:0")
+            self.assertTrue(device.window_open)
+            if mode == "episodes":
+                self.assertIsNotNone(device.episode_start)
+            operator.close_state()
+            operator = self.create_operator(f"restarted_{mode}", **config)
+            outputs += stream(operator, records[cut + 1:])
+            operator.close_state()
+            self.assertEqual(outputs, expected)
+            self.assertEqual(self.device_states(f"restarted_{mode}", **config), states)
+
+            operator = self.create_operator(f"batch_{mode}", **config)
+            outputs = operator.run_batch("room:0", [(timestamp, window_open) for _, timestamp, window_open in records])
+            operator.close_state()
+            self.assertEqual(outputs, expected)
+            self.assertEqual(self.device_states(f"batch_{mode}", **config)["room:0"][1], histories)
+
+            operator = self.create_operator(f"batched_{mode}", batch_messages=64, batch_interval=3600, **config)
+            stream(operator, records)
+            operator.close_state()
+            self.assertEqual(operator.produced, expected)
+            self.assertEqual(self.device_states(f"batched_{mode}", **config), states)
+
+    def test_export_import(self):
+        records = generate_room_events(rooms=3, days=20, seed=11)
+        # Also with messages held back in the reorder buffer at the export
+        for i, (config, records) in enumerate((({}, records), ({"reorder_window": 3600}, delay(records, 1800)))):
+            operator = self.create_operator(f"uninterrupted_{i}", **config)
+            expected = stream(operator, records)
+            operator.close_state()
+
+            operator = self.create_operator(f"exported_{i}", **config)
+            outputs = list(stream(operator, records[:len(records)//2]))
+            path = os.path.join(self.data_path.name, f"state_{i}.npz")
+            operator.export_state(path)
+            operator.close_state()
+            operator = self.create_operator(f"imported_{i}", **config)
+            self.assertEqual(operator.import_state(path), 3)
+            outputs += stream(operator, records[len(records)//2:])
+            operator.close_state()
+            self.assertGreater(len(expected), 40)
+            self.assertEqual(outputs, expected)
+
+    def test_reorder_buffer_survives_restart(self):
+        records = delay(generate_room_events(rooms=2, days=10, seed=7), 1800)
+        operator = self.create_operator("uninterrupted", reorder_window=3600)
+        expected = stream(operator, records)
+        operator.close_state()
+
+        operator = self.create_operator("restarted", reorder_window=3600)
+        outputs = stream(operator, records[:len(records)//2])
+        held = sum(len(operator.devices.get(device_id).reorder_buffer) for device_id in ("room:0", "room:1"))
+        operator.close_state()
+        operator = self.create_operator("restarted", reorder_window=3600)
+        outputs += stream(operator, records[len(records)//2:])
+        operator.close_state()
+        self.assertGreater(held, 0)
+        self.assertEqual(outputs, expected)
+
+    def test_replay_after_crash(self):
+        records = crash_records()
+        # Checkpoints only on close, every 37 messages, and released messages of the reorder buffer produced while replaying
+        for i, config in enumerate(({}, {"checkpoint_messages": 37}, {"reorder_window": 3600})):
+            operator = self.create_operator(f"reference_{i}", **config)
+            expected = stream(operator, records)
+            operator.close_state()
+            expected_state = self.device_states(f"reference_{i}", **config)
+
+            for cut in (1, 300, len(records)//2, len(records) - 1):
+                name = f"crash_{i}_{cut}"
+                crash = subprocess.run([sys.executable, "-c", CRASH, os.path.join(self.data_path.name, name), str(cut), json.dumps(config)],
+                                       cwd=REPOSITORY, capture_output=True, text=True)
+                self.assertEqual(crash.returncode, 1, crash.stderr)
+                outputs = json.loads(crash.stdout.strip().splitlines()[-1])
+                operator = self.create_operator(name, **config)
+                # The replayed messages' outputs have been produced before the crash.
+                self.assertEqual(operator.produced, [])
+                outputs += stream(operator, records[cut:])
+                operator.close_state()
+                self.assertEqual(outputs, expected)
+                self.assertEqual(self.device_states(name, **config), expected_state)
+
+    def test_replay_skips_failing_record(self):
+        records = crash_records()
+        operator = self.create_operator("reference")
+        expected = stream(operator, records)
+        operator.close_state()
+
+        operator = self.create_operator("failing")
+        outputs = stream(operator, records[:300])
+        operator.close_state()
+        # A record that cannot be applied, left in the write-ahead log
+        wal = WriteAheadLog(os.path.join(self.data_path.name, "failing"))
+        wal.append({"device_id": "room:0", "timestamp": "not a timestamp", "window_open": True})
+        wal.close()
+        for _ in range(2):
+            operator = self.create_operator("failing")
+            operator.close_state()
+        operator = self.create_operator("failing")
+        outputs += stream(operator, records[300:])
+        operator.close_state()
+        self.assertEqual(outputs, expected)
+
+    def test_messages_without_device_id(self):
+        records = generate_room_events(rooms=1, days=10, seed=8)
+        operator = self.create_operator("with_id")
+        expected = stream(operator, records)
+        operator.close_state()
+
+        operator = self.create_operator("without_id")
+        outputs = stream(operator, [(None, timestamp, window_open) for _, timestamp, window_open in records[:len(records)//2]])
+        operator.close_state()
+        operator = self.create_operator("without_id")
+        outputs += stream(operator, [(None, timestamp, window_open) for _, timestamp, window_open in records[len(records)//2:]])
+        operator.close_state()
+        self.assertGreater(len(expected), 5)
+        self.assertEqual(outputs, expected)
+
+    def test_forecast_workers_match_synchronous(self):
+        records = generate_room_events(rooms=3, days=21, seed=9)
+        operator = self.create_operator("synchronous")
+        expected = stream(operator, records)
+        operator.close_state()
+
+        # Checkpoints while forecasts are computing
+        config = {"forecast_workers": 2, "checkpoint_messages": 50}
+        operator = self.create_operator("workers", **config)
+        stream(operator, records)
+        operator.close_state()
+        self.assertGreater(len(expected), 40)
+        # Interleaved differently across devices, each device's forecasts are produced in order
+        self.assertEqual(sorted(operator.produced, key=json.dumps), sorted(expected, key=json.dumps))
+        self.assertEqual(self.device_states("workers", **config), self.device_states("synchronous"))
+
+    def test_replay_forecasts_computing_at_crash(self):
+        records = crash_records()
+        operator = self.create_operator("reference")
+        expected = stream(operator, records)
+        operator.close_state()
+
+        # Around the start of Monday, 23:00 UTC, the weekend has too few openings for a forecast
+        first, second = (sum(timestamp < pd.Timestamp(time) for _, timestamp, _ in records) for time in ("2024-01-07 22:00", "2024-01-08 00:00"))
+        with tempfile.TemporaryFile("w+") as stdout:
+            crash = subprocess.Popen([sys.executable, "-c", PENDING_CRASH, os.path.join(self.data_path.name, "crash"), str(first), str(second)],
+                                     cwd=REPOSITORY, stdout=stdout, start_new_session=True)
+            self.assertEqual(crash.wait(timeout=60), 1)
+            try:
+                # The worker processes go down with it
+                os.killpg(crash.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            stdout.seek(0)
+            outputs = json.loads(stdout.read().strip().splitlines()[-1])
+        operator = self.create_operator("crash", forecast_workers=1, metrics_file=os.path.join(self.data_path.name, "metrics.prom"))
+        # The devices' states were not saved while their forecasts were computing. The forecasts produced before are
+        # cached, only the ones computing at the crash are produced again.
+        hits = [line for line in operator.metrics.render().splitlines() if line.startswith("automatic_heating_forecast_cache_hits_total ")]
+        self.assertGreater(len(outputs), 5)
+        self.assertEqual(len(operator.produced), 2)
+        stream(operator, records[second:])
+        operator.close_state()
+        outputs += operator.produced
+        self.assertGreater(float(hits[0].split()[1]), 0)
+        self.assertEqual(sorted(outputs, key=json.dumps), sorted(expected, key=json.dumps))
+
+    def device_states(self, name, **config):
+        # Metadata and histories of every device, as lists
+        operator = self.create_operator(name, **config)
+        with operator.lock:
+            states = {device_id: (operator.devices.get(device_id).metadata(), {bucket: history.tolist() for bucket, history in operator.devices.get(device_id).histories().items()})
+                      for device_id in operator.devices.device_ids()}
+        operator.close_state()
+        return states
+
+    def test_horizon_matches_next_forecast(self):
+        # The first day of the horizon after a day's messages is the forecast computed when the next day starts.
+        records = generate_room_events(rooms=1, days=21, seed=3)
+        operator = self.create_operator("horizon")
+        # The first day is the init phase, without a horizon
+        stream(operator, [record for record in records if record[1] < pd.Timestamp("2024-01-01 23:00")])
+        compared = 0
+        for day in pd.date_range("2024-01-02", "2024-01-20"):
+            # Days start at 23:00 UTC in winter, a message with the window closed starts the next one.
+            day_end = day + pd.Timedelta(hours=23)
+            stream(operator, [record for record in records if day_end - pd.Timedelta(days=1) <= record[1] < day_end])
+            horizon = [entry for entry in operator.forecast_horizon("room:0", 2) if entry["horizon"] == 1]
+            forecast = operator.run({"window_open": False}, None, "room:0", day_end.to_pydatetime())
+            if forecast:
+                self.assertEqual([{key: entry[key] for key in ("stopping_time", "overall_confidence")} for entry in horizon],
+                                 [{key: entry[key] for key in ("stopping_time", "overall_confidence")} for entry in forecast])
+                compared += 1
+        operator.close_state()
+        self.assertGreater(compared, 15)
+
+
 if __name__ == '__main__':
     unittest.main()
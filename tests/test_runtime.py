@@ -0,0 +1,135 @@
+"""
+   Copyright 2022 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import runtime
+import datetime
+import os
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+import unittest
+
+
+class TestTimeConversion(unittest.TestCase):
+    def test_utc_to_local_matches_pandas(self):
+        rng = np.random.default_rng(0)
+        utc_ns = rng.integers(pd.Timestamp("1990-01-01").value, pd.Timestamp("2036-01-01").value, 20000)
+        # Every ten minutes around the transitions of 2024
+        transitions = np.array([pd.Timestamp("2024-03-31 01:00").value, pd.Timestamp("2024-10-27 01:00").value])
+        utc_ns = np.concatenate((utc_ns, (transitions[:, np.newaxis] + np.arange(-3*3600, 3*3600, 600)*10**9).ravel()))
+        expected = pd.DatetimeIndex(utc_ns).tz_localize("UTC").tz_convert("Europe/Berlin").tz_localize(None).asi8
+
+        np.testing.assert_array_equal(runtime.utc_to_local_array(utc_ns), expected)
+        np.testing.assert_array_equal([runtime.utc_to_local(int(ns)) for ns in utc_ns], expected)
+        # Only the repeated hour in autumn does not round trip to the same UTC time.
+        np.testing.assert_array_equal([runtime.utc_to_local(runtime.local_to_utc(int(ns))) for ns in expected], expected)
+
+    def test_utc_to_local_follows_tz_database(self):
+        # Summer time of 1980 (the first one since 1949) and the double summer time of 1947
+        utc_ns = np.arange(pd.Timestamp("1947-01-01").value, pd.Timestamp("1982-01-01").value, 3*3600*10**9 + 7*10**9)
+        utc_ns = np.concatenate((utc_ns, [pd.Timestamp("1980-04-06 00:59:59").value, pd.Timestamp("1980-04-06 01:00").value]))
+        expected = pd.DatetimeIndex(utc_ns).tz_localize("UTC").tz_convert("Europe/Berlin").tz_localize(None).asi8
+
+        np.testing.assert_array_equal(runtime.utc_to_local_array(utc_ns), expected)
+        np.testing.assert_array_equal([runtime.utc_to_local(int(ns)) for ns in utc_ns], expected)
+
+    def test_local_to_utc_at_transitions(self):
+        # The skipped hour keeps the winter offset, the repeated hour resolves to summer time.
+        nonexistent = pd.Timestamp("2024-03-31 02:30").value
+        self.assertEqual(runtime.local_to_utc(nonexistent), pd.Timestamp("2024-03-31 01:30").value)
+        ambiguous = pd.Timestamp("2024-10-27 02:30").value
+        self.assertEqual(runtime.local_to_utc(ambiguous), pd.Timestamp("2024-10-27 00:30").value)
+
+    def test_format_and_parse(self):
+        for timestamp in ("2024-01-01 10:00:00", "2024-07-01 10:00:00.123", "2024-07-01 10:00:00.123456789"):
+            ns = pd.Timestamp(timestamp).value
+            self.assertEqual(runtime.format_utc(ns), pd.Timestamp(timestamp).isoformat() + "Z")
+        self.assertEqual(runtime.to_utc_nanoseconds(datetime.datetime(2024, 1, 1, 10, 0, 0, 5)), pd.Timestamp("2024-01-01 10:00:00.000005").value)
+        self.assertEqual(runtime.to_utc_nanoseconds("2022-04-01T06:00:00.030Z"), pd.Timestamp("2022-04-01 06:00:00.030").value)
+        aware = datetime.datetime(2024, 1, 1, 11, tzinfo=datetime.timezone(datetime.timedelta(hours=1)))
+        self.assertEqual(runtime.to_utc_nanoseconds(aware), pd.Timestamp("2024-01-01 10:00").value)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_disabled_metrics_record_nothing(self):
+        metrics = runtime.Metrics(enabled=False)
+        self.assertIs(metrics.timer("a"), metrics.timer("b"))
+        with metrics.timer("a"):
+            metrics.inc("messages_total")
+            metrics.set("history_length", 3, device="d")
+        self.assertEqual(metrics.render(), "\n")
+
+    def test_render(self):
+        metrics = runtime.Metrics()
+        for _ in range(3):
+            with metrics.timer("store"):
+                pass
+        metrics.inc("messages_total")
+        metrics.inc("messages_total", 2)
+        metrics.add_collector(lambda m: m.set("history_length", 5, device="d", bucket="weekday"))
+        lines = metrics.render().splitlines()
+        self.assertIn('automatic_heating_stage_seconds_count{stage="store"} 3', lines)
+        self.assertIn("# TYPE automatic_heating_messages_total counter", lines)
+        self.assertIn("automatic_heating_messages_total 3", lines)
+        self.assertIn('automatic_heating_history_length{bucket="weekday",device="d"} 5', lines)
+
+    def test_exporter_writes_file_on_stop(self):
+        metrics = runtime.Metrics()
+        metrics.inc("messages_total")
+        with tempfile.TemporaryDirectory() as path:
+            exporter = runtime.MetricsExporter(metrics, file_path=os.path.join(path, "metrics.prom"), interval=3600)
+            exporter.start()
+            exporter.stop()
+            with open(os.path.join(path, "metrics.prom")) as f:
+                self.assertEqual(f.read(), metrics.render())
+
+
+class TestForecastScheduler(unittest.TestCase):
+    def test_results_in_order_per_key(self):
+        results = []
+        lock = threading.RLock()
+        scheduler = runtime.ForecastScheduler(lambda context, future: results.append((context, future.result())), lock, workers=2, max_pending=3)
+        scheduler.start()
+        with lock:
+            for i in range(10):
+                key = f"device:{i % 3}"
+                if i % 4 == 0:
+                    scheduler.put(key, (key, i), -i)
+                else:
+                    scheduler.submit(key, (key, i), sum, range(i))
+                self.assertLessEqual(scheduler.pending, 3)
+        scheduler.stop()
+        self.assertEqual(scheduler.pending, 0)
+        self.assertEqual(sorted(results), sorted(((f"device:{i % 3}", i), -i if i % 4 == 0 else sum(range(i))) for i in range(10)))
+        for key in ("device:0", "device:1", "device:2"):
+            order = [i for (k, i), _ in results if k == key]
+            self.assertEqual(order, sorted(order))
+
+    def test_flush_delivers_pending_results(self):
+        results = []
+        lock = threading.RLock()
+        scheduler = runtime.ForecastScheduler(lambda context, future: results.append(future.result()), lock, workers=2)
+        with lock:
+            for i in range(5):
+                scheduler.submit(f"device:{i}", None, sum, range(i))
+            scheduler.flush()
+            self.assertEqual((scheduler.pending, sorted(results)), (0, [0, 0, 1, 3, 6]))
+        scheduler.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
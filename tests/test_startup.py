@@ -0,0 +1,70 @@
+"""
+   Copyright 2022 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cold start budgets in seconds, measured in a fresh interpreter
+ALGO_IMPORT_BUDGET = 1.0
+OPERATOR_START_BUDGET = 5.0
+
+
+def measure_in_subprocess(code):
+    # Runs code in a fresh interpreter, code has to print a json object.
+    output = subprocess.run([sys.executable, "-c", code], cwd=REPOSITORY, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+class TestStartup(unittest.TestCase):
+    def test_algo_import(self):
+        result = measure_in_subprocess(
+            "import json, sys, time\n"
+            "start = time.perf_counter()\n"
+            "import algo\n"
+            "duration = time.perf_counter() - start\n"
+            "algo.compute_clusters_boundaries(algo.np.arange(100)*1000)\n"
+            "print(json.dumps({'duration': duration, 'sklearn': 'sklearn' in sys.modules}))"
+        )
+        self.assertLess(result["duration"], ALGO_IMPORT_BUDGET)
+        self.assertFalse(result["sklearn"])
+
+    def test_operator_start(self):
+        try:
+            result = measure_in_subprocess(
+                "import json, tempfile, time\n"
+                "start = time.perf_counter()\n"
+                "from main import Operator, CustomConfig\n"
+                "with tempfile.TemporaryDirectory() as data_path:\n"
+                "    operator = Operator()\n"
+                "    operator.config = CustomConfig({'data_path': data_path})\n"
+                "    operator.setup_state()\n"
+                "    operator.close_state()\n"
+                "print(json.dumps({'duration': time.perf_counter() - start}))"
+            )
+        except subprocess.CalledProcessError as ex:
+            if "ModuleNotFoundError" in ex.stderr:
+                self.skipTest(ex.stderr.strip().splitlines()[-1])
+            raise
+        self.assertLess(result["duration"], OPERATOR_START_BUDGET)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,285 @@
+"""
+   Copyright 2022 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import storage
+import numpy as np
+import os
+import tempfile
+import threading
+import unittest
+
+
+class TestEventStore(unittest.TestCase):
+    def test_append_prune_reopen(self):
+        with tempfile.TemporaryDirectory() as path:
+            store = storage.EventStore(path, compaction_threshold=10)
+            self.assertFalse(store.exists())
+            store.extend("weekday", np.arange(100))
+            store.append("weekend", 5)
+            self.assertTrue(store.exists())
+
+            expired = store.prune("weekday", 50)
+            np.testing.assert_array_equal(expired, np.arange(50))
+            np.testing.assert_array_equal(store.timestamps("weekday"), np.arange(50, 100))
+            store.append("weekday", 100)
+            store.close()
+
+            store = storage.EventStore(path, compaction_threshold=10)
+            np.testing.assert_array_equal(store.timestamps("weekday"), np.arange(50, 101))
+            np.testing.assert_array_equal(store.timestamps("weekend"), [5])
+            self.assertEqual(len(store.prune("weekend", 0)), 0)
+            store.close()
+
+    def test_compaction(self):
+        with tempfile.TemporaryDirectory() as path:
+            store = storage.EventStore(path, compaction_threshold=10)
+            store.extend("weekday", np.arange(30))
+            store.prune("weekday", 25)
+            store.append("weekday", 30)
+            store.close()
+
+            store = storage.EventStore(path, compaction_threshold=10)
+            np.testing.assert_array_equal(store.timestamps("weekday"), np.arange(25, 31))
+            store.close()
+
+    def test_drop(self):
+        with tempfile.TemporaryDirectory() as path:
+            store = storage.EventStore(path, buckets=("weekday", "weekday_duration"))
+            store.extend("weekday_duration", [30, 10, 20])
+            np.testing.assert_array_equal(store.drop("weekday_duration", 2), [30, 10])
+            self.assertEqual(len(store.drop("weekday_duration", 5)), 1)
+            self.assertEqual(store.count("weekday_duration"), 0)
+            store.close()
+
+    def test_uncommitted_changes_are_discarded(self):
+        with tempfile.TemporaryDirectory() as path:
+            store = storage.EventStore(path)
+            store.extend("weekday", np.arange(10))
+            store.commit({"seq": 1})
+            store.append("weekday", 10)
+            store.prune("weekday", 5)
+            np.testing.assert_array_equal(store.timestamps("weekday"), np.arange(5, 11))
+            # Simulate a crash: The appended entry reached the segment file, the meta file was not updated.
+            with open(os.path.join(path, "weekday.0.i64"), "ab") as f:
+                f.write(np.int64(10).tobytes())
+
+            store = storage.EventStore(path)
+            np.testing.assert_array_equal(store.timestamps("weekday"), np.arange(10))
+            self.assertEqual(store.metadata, {"seq": 1})
+            store.append("weekday", 11)
+            store.close()
+            store = storage.EventStore(path)
+            np.testing.assert_array_equal(store.timestamps("weekday"), np.append(np.arange(10), 11))
+            store.close()
+
+    def test_insert_late_entries(self):
+        with tempfile.TemporaryDirectory() as path:
+            store = storage.EventStore(path)
+            store.extend("weekday", [10, 20, 30])
+            store.commit()
+            store.insert("weekday", [40, 35])
+            store.commit()
+            self.assertEqual(sorted(os.listdir(path)), ["meta.json", "weekday.0.i64"])
+            store.insert("weekday", [15])
+            store.append("weekday", 50)
+            store.close()
+
+            store = storage.EventStore(path)
+            np.testing.assert_array_equal(store.timestamps("weekday"), [10, 15, 20, 30, 35, 40, 50])
+            self.assertEqual(sorted(os.listdir(path)), ["meta.json", "weekday.1.i64"])
+            store.close()
+
+    @unittest.skipUnless(os.path.isdir("/proc/self/fd"), "needs /proc")
+    def test_no_open_files_between_commits(self):
+        with tempfile.TemporaryDirectory() as path:
+            open_files = len(os.listdir("/proc/self/fd"))
+            stores = [storage.EventStore(os.path.join(path, str(i))) for i in range(50)]
+            for store in stores:
+                store.extend("weekday", [10, 20])
+                store.append("weekend", 30)
+                store.commit()
+            self.assertEqual(len(os.listdir("/proc/self/fd")), open_files)
+            for store in stores:
+                store.close()
+
+
+class TestSlidingWindow(unittest.TestCase):
+    def test_matches_list(self):
+        rng = np.random.default_rng(0)
+        window = storage.SlidingWindow(capacity=4)
+        expected = []
+        now = 0
+        for _ in range(2000):
+            now += int(rng.integers(1, 100))
+            if rng.random() < 0.3:
+                values = now + np.arange(int(rng.integers(0, 20)))
+                now = int(values[-1]) if len(values) else now
+                window.extend(values)
+                expected.extend(values)
+            else:
+                window.append(now)
+                expected.append(now)
+            cutoff = now - 3000
+            np.testing.assert_array_equal(window.expire(cutoff), [value for value in expected if value < cutoff])
+            expected = [value for value in expected if value >= cutoff]
+            np.testing.assert_array_equal(window.view(), expected)
+        self.assertEqual(len(window), len(expected))
+
+    def test_views_are_stable(self):
+        window = storage.SlidingWindow(np.arange(4), capacity=4)
+        view = window.view()
+        window.drop(3)
+        window.extend(np.arange(4, 20))
+        np.testing.assert_array_equal(view, np.arange(4))
+        self.assertFalse(view.flags.writeable)
+
+    def test_insert(self):
+        window = storage.SlidingWindow([10, 20, 30])
+        view = window.view()
+        self.assertEqual(window.insert([40]), 3)
+        self.assertEqual(window.insert([25, 5, 30]), 0)
+        np.testing.assert_array_equal(window.view(), [5, 10, 20, 25, 30, 30, 40])
+        np.testing.assert_array_equal(view, [10, 20, 30])
+        np.testing.assert_array_equal(window.expire(21), [5, 10, 20])
+
+
+class TestWriteAheadLog(unittest.TestCase):
+    def test_replay_after_checkpoint(self):
+        with tempfile.TemporaryDirectory() as path:
+            wal = storage.WriteAheadLog(path)
+            self.assertEqual(wal.append({"device_id": "a"}), 1)
+            wal.checkpoint(1)
+            self.assertEqual(wal.append({"device_id": "b"}), 2)
+            self.assertEqual(wal.append({"device_id": "c"}), 3)
+            wal.close()
+            with open(os.path.join(path, "wal.jsonl"), "a") as f:
+                f.write('{"seq": 4, "dev')  # torn write of a crashed process
+
+            wal = storage.WriteAheadLog(path)
+            self.assertEqual([record["device_id"] for record in wal.records()], ["b", "c"])
+            self.assertEqual(wal.last_seq, 3)
+            wal.checkpoint(3)
+            self.assertEqual(list(wal.records()), [])
+            self.assertEqual(wal.append({"device_id": "d"}), 4)
+            wal.close()
+
+    def test_retain_records(self):
+        with tempfile.TemporaryDirectory() as path:
+            wal = storage.WriteAheadLog(path)
+            for device_id in "abcd":
+                wal.append({"device_id": device_id})
+            wal.checkpoint(2, retained_until=4)
+            self.assertEqual(wal.append({"device_id": "e"}), 5)
+            wal.close()
+            with open(os.path.join(path, "wal.jsonl")) as f:
+                self.assertEqual(len(f.readlines()), 3)
+
+            wal = storage.WriteAheadLog(path)
+            self.assertEqual([record["device_id"] for record in wal.records()], ["c", "d", "e"])
+            self.assertEqual((wal.checkpoint_seq, wal.retained_until, wal.last_seq), (2, 4, 5))
+            wal.checkpoint(5)
+            self.assertEqual((list(wal.records()), wal.retained_until), ([], 0))
+            wal.close()
+
+
+class TestCheckpointer(unittest.TestCase):
+    def test_checkpoint_on_pending_and_stop(self):
+        checkpoints = []
+        done = threading.Event()
+        def checkpoint():
+            checkpoints.append(1)
+            done.set()
+        checkpointer = storage.Checkpointer(checkpoint, threading.RLock(), interval=3600, max_pending=3)
+        checkpointer.start()
+        checkpointer.notify(2)
+        self.assertFalse(done.wait(0.05))
+        checkpointer.notify()
+        self.assertTrue(done.wait(5))
+        checkpointer.stop()
+        self.assertEqual(len(checkpoints), 2)
+
+
+class MockDeviceState:
+    def __init__(self, device_id, path, created):
+        self.device_id = device_id
+        self.path = path
+        self.created = created
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestDeviceRegistry(unittest.TestCase):
+    def test_lru_eviction(self):
+        with tempfile.TemporaryDirectory() as path:
+            registry = storage.DeviceRegistry(path, MockDeviceState, capacity=2)
+            a = registry.get("device:a")
+            b = registry.get("device:b")
+            self.assertTrue(a.created)
+            self.assertIs(registry.get("device:a"), a)
+            registry.get("device:c")
+            self.assertTrue(b.closed)
+            self.assertFalse(a.closed)
+            self.assertEqual(len(registry.loaded()), 2)
+
+            b = registry.get("device:b")
+            self.assertFalse(b.created)
+            self.assertNotEqual(a.path, b.path)
+            registry.close()
+
+            registry = storage.DeviceRegistry(path, MockDeviceState, capacity=2)
+            self.assertEqual(sorted(registry.device_ids()), ["device:a", "device:b", "device:c"])
+
+
+class TestForecastCache(unittest.TestCase):
+    def test_eviction_and_persistence(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = storage.ForecastCache(os.path.join(path, "cache.json"), max_entries=2)
+            cache.put(("device:a", "2024-01-01", "weekday", (3, 1, 2)), [{"stopping_time": "x"}])
+            cache.put(("device:a", "2024-01-02", "weekday", (4, 1, 3)), [])
+            self.assertEqual(cache.get(("device:a", "2024-01-01", "weekday", (3, 1, 2))), [{"stopping_time": "x"}])
+            cache.put(("device:b", "2024-01-02", "weekday", (1, )), [])
+            self.assertIsNone(cache.get(("device:a", "2024-01-02", "weekday", (4, 1, 3))))
+
+            cache = storage.ForecastCache(os.path.join(path, "cache.json"), max_entries=2)
+            self.assertEqual(len(cache), 2)
+            self.assertEqual(cache.get(["device:a", "2024-01-01", "weekday", [3, 1, 2]]), [{"stopping_time": "x"}])
+
+
+class TestColumnar(unittest.TestCase):
+    def test_round_trip(self):
+        devices = [
+            ("device:a", {"weekday": np.arange(5), "weekend": np.array([7])}, {"seq": 3, "window_open": True}),
+            ("device:b", {"weekday": np.array([], dtype=np.int64)}, {"seq": 4})
+        ]
+        with tempfile.TemporaryDirectory() as path:
+            file_path = os.path.join(path, "state.npz")
+            storage.write_columnar(file_path, devices, ("weekday", "weekend"))
+            read = list(storage.read_columnar(file_path))
+            self.assertEqual([(device_id, metadata) for device_id, _, metadata in read], [(device_id, metadata) for device_id, _, metadata in devices])
+            np.testing.assert_array_equal(read[0][1]["weekday"], np.arange(5))
+            np.testing.assert_array_equal(read[0][1]["weekend"], [7])
+            self.assertEqual(len(read[1][1]["weekday"]), 0)
+            self.assertEqual(len(read[1][1]["weekend"]), 0)
+
+            np.savez(file_path, schema=np.array('{"format": "automatic_heating_state", "version": 99}'))
+            with self.assertRaises(ValueError):
+                list(storage.read_columnar(file_path))
+
+
+if __name__ == '__main__':
+    unittest.main()